@@ -0,0 +1,199 @@
+"""
+Shared harness for the scannertools benchmark scripts.
+
+Each benchmark script produces a dict mapping a case name to a dict of metrics. Results can be
+saved as a baseline JSON file, and later runs are compared against it so that regressions are
+reported (and the script exits non-zero).
+
+No baselines are checked in, since the numbers depend on the machine: run a script with
+--save-baseline once to record one in benchmarks/baselines/. A baseline stores the machine and
+settings it was recorded with, and is only compared against runs with the same ones.
+"""
+
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing as mp
+import argparse
+import tracemalloc
+import resource
+import platform
+import json
+import time
+import sys
+import os
+
+BASELINE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'baselines')
+
+# Metric name -> whether larger values are better
+METRICS = {
+    'latency_ms': False,
+    'latency_p95_ms': False,
+    'throughput': True,
+    'peak_rss_mb': False,
+    'alloc_blocks': False,
+    'alloc_peak_mb': False,
+    'precision': True,
+    'recall': True,
+    'mean_iou': True,
+}
+
+
+def timed(f, repeat=3):
+    """
+    Runs f() `repeat` times and returns the list of wall-clock durations in seconds.
+    """
+    durations = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        f()
+        durations.append(time.perf_counter() - start)
+    return durations
+
+
+def traced(f):
+    """
+    Runs f() once under tracemalloc and returns (number of allocated blocks still live at the end,
+    peak traced memory in MB).
+    """
+    tracemalloc.start()
+    try:
+        result = f()
+        snapshot = tracemalloc.take_snapshot()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    del result
+    blocks = sum(stat.count for stat in snapshot.statistics('filename'))
+    return blocks, peak / (1024. * 1024.)
+
+
+def percentile(xs, p):
+    xs = sorted(xs)
+    return xs[min(int(len(xs) * p / 100.), len(xs) - 1)]
+
+
+def peak_rss_mb():
+    # ru_maxrss is in kilobytes on Linux
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.
+
+
+def _run_case(fn, args):
+    metrics = fn(*args)
+    metrics['peak_rss_mb'] = peak_rss_mb()
+    return metrics
+
+
+def run_isolated(fn, *args):
+    """
+    Runs a benchmark case in a fresh process so its peak RSS is not polluted by other cases.
+
+    fn must be a module-level function returning a dict of metrics.
+    """
+    with ProcessPoolExecutor(max_workers=1, mp_context=mp.get_context('spawn')) as executor:
+        return executor.submit(_run_case, fn, args).result()
+
+
+def settings(args):
+    """
+    Returns the machine and benchmark settings that results depend on, as stored with a baseline.
+    """
+    return {
+        'machine': platform.machine(),
+        'processor': platform.processor(),
+        'cpus': os.cpu_count(),
+        'python': platform.python_version(),
+        'quick': args.quick
+    }
+
+
+def load_baseline(path):
+    """
+    Returns:
+        (dict, dict): The settings a baseline was recorded with and its results, or None if there
+        is no baseline at path.
+    """
+    if not os.path.isfile(path):
+        return None
+    with open(path) as f:
+        baseline = json.load(f)
+    return baseline['settings'], baseline['results']
+
+
+def save_baseline(path, settings, results):
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as f:
+        json.dump({'settings': settings, 'results': results}, f, indent=2, sort_keys=True)
+
+
+def compare(results, baseline, tolerance):
+    """
+    Returns a list of (case, metric, baseline value, new value) for every metric that got worse
+    than the baseline by more than `tolerance` (a fraction, e.g. 0.2 for 20%).
+    """
+    regressions = []
+    for case, metrics in sorted(results.items()):
+        for metric, value in sorted(metrics.items()):
+            if metric not in METRICS or metric not in baseline.get(case, {}):
+                continue
+            base = baseline[case][metric]
+            if base == 0:
+                continue
+            change = (value - base) / base
+            if (-change if METRICS[metric] else change) > tolerance:
+                regressions.append((case, metric, base, value))
+    return regressions
+
+
+def report(results):
+    for case, metrics in sorted(results.items()):
+        print('{}: {}'.format(case, ', '.join(
+            '{}={:.3f}'.format(k, v) for k, v in sorted(metrics.items()))))
+
+
+def arg_parser(name, description):
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument(
+        '--baseline',
+        default=os.path.join(BASELINE_DIR, '{}.json'.format(name)),
+        help='Path to the baseline JSON file')
+    parser.add_argument(
+        '--save-baseline',
+        action='store_true',
+        help='Overwrite the baseline with the results of this run')
+    parser.add_argument(
+        '--tolerance',
+        type=float,
+        default=0.2,
+        help='Fractional slowdown that counts as a regression')
+    parser.add_argument('--quick', action='store_true', help='Run a reduced set of cases')
+    return parser
+
+
+def finish(args, results):
+    """
+    Prints results, then saves or compares against the baseline. Exits non-zero on regression.
+    """
+    report(results)
+
+    current = settings(args)
+    if args.save_baseline:
+        save_baseline(args.baseline, current, results)
+        print('Saved baseline to {}'.format(args.baseline))
+        return
+
+    loaded = load_baseline(args.baseline)
+    if loaded is None:
+        print('No baseline at {}, run with --save-baseline to create one'.format(args.baseline))
+        return
+
+    (recorded, baseline) = loaded
+    if recorded != current:
+        print('Baseline at {} was recorded with {}, but this run has {}. Not comparing, run with '
+              '--save-baseline to replace it'.format(args.baseline, recorded, current))
+        return
+
+    regressions = compare(results, baseline, args.tolerance)
+    for (case, metric, base, value) in regressions:
+        print('REGRESSION {} {}: {:.3f} -> {:.3f}'.format(case, metric, base, value))
+
+    if len(regressions) > 0:
+        sys.exit(1)
@@ -0,0 +1,88 @@
+"""
+Compares DetectClothing.detect_edge_text against the original per-pixel Python loop on typical
+clothing crop sizes, and checks that both return the same row. Usage:
+
+    python3 benchmarks/edge_text.py [--quick] [--save-baseline]
+"""
+
+from scannertools.clothing_detection import DetectClothing
+from common import arg_parser, finish, run_isolated, timed
+import numpy as np
+
+# (height, width) of the crop around a face: twice the face width across and twice that down
+CROP_SIZES = [(240, 120), (480, 240), (800, 400)]
+
+
+def detect_edge_text_reference(img, start_y=40):
+    import cv2
+    edges = cv2.Canny(img, 80, 80)
+    img_bright = np.max(img, axis=2)
+    H, W = img_bright.shape
+    img_bright = img_bright.astype('int')
+    BOUNDARY_THRESH = 0.5
+    CONTRAST_THRESH = 96
+    TEXT_THRESH = 0.45
+    HEAD_THRESH = 0.3
+    start_y = int((H - start_y) * HEAD_THRESH + start_y)
+    for y in range(start_y, H):
+        find_edge = False
+        find_text = False
+        non_zero = np.count_nonzero(edges[y])
+        if 1. * non_zero / W > BOUNDARY_THRESH:
+            find_edge = True
+        cnt_grad = 0
+        for x in range(W):
+            grad_horiz = False
+            neighbor = [-2, -1, 1, 2]
+            for i in neighbor:
+                if x + i < 0 or x + i > W - 1:
+                    continue
+                if np.fabs(img_bright[y, x + i] - img_bright[y, x]) > CONTRAST_THRESH:
+                    grad_horiz = True
+                    break
+            if grad_horiz:
+                cnt_grad += 1
+        if 1. * cnt_grad / W > TEXT_THRESH:
+            find_text = True
+        if find_edge or find_text:
+            return y
+    return H
+
+
+def _crop(height, width, collar):
+    rng = np.random.RandomState(0)
+    img = (rng.rand(height, width, 3) * 60).astype(np.uint8)
+    if collar:
+        # A bright horizontal band, like a collar or on-screen text, at 80% of the height
+        img[int(height * 0.8):int(height * 0.8) + 4, :] = 255
+    return img
+
+
+def bench(height, width, collar, reference):
+    img = _crop(height, width, collar)
+    start_y = height // 6
+    fn = detect_edge_text_reference if reference else DetectClothing.detect_edge_text
+    assert fn(img, start_y) == DetectClothing.detect_edge_text(img, start_y)
+    durations = timed(lambda: fn(img, start_y), repeat=1 if reference else 10)
+    return {'throughput': 1 / min(durations), 'latency_ms': min(durations) * 1000}
+
+
+def main():
+    parser = arg_parser('edge_text', __doc__)
+    args = parser.parse_args()
+
+    results = {}
+    for (height, width) in CROP_SIZES[:1] if args.quick else CROP_SIZES:
+        for collar in [False, True]:
+            key = '{}x{}{}'.format(width, height, '_collar' if collar else '')
+            results['vectorized/' + key] = run_isolated(bench, height, width, collar, False)
+            results['reference/' + key] = run_isolated(bench, height, width, collar, True)
+            print('{}: {:.0f}x speedup'.format(
+                key, results['reference/' + key]['latency_ms'] /
+                results['vectorized/' + key]['latency_ms']))
+
+    finish(args, results)
+
+
+if __name__ == '__main__':
+    main()
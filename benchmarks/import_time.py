@@ -0,0 +1,79 @@
+"""
+Measures how long `import scannertools` takes in a fresh interpreter, and checks that heavy
+optional dependencies are not loaded until a pipeline module is used. Usage:
+
+    python3 benchmarks/import_time.py [--budget-ms 1500] [--save-baseline]
+"""
+
+from common import arg_parser, finish, percentile
+import subprocess as sp
+import json
+import sys
+
+# Modules that should only be imported on first use of a pipeline
+HEAVY_MODULES = ['cv2', 'scipy', 'PIL', 'tensorflow', 'torch']
+
+SCRIPT = """
+import time, sys, json
+start = time.perf_counter()
+import {module}
+{access}
+duration = time.perf_counter() - start
+print(json.dumps({{'duration': duration, 'modules': sorted(sys.modules.keys())}}))
+"""
+
+
+def measure(module='scannertools', access='', repeat=5):
+    runs = []
+    for _ in range(repeat):
+        out = sp.check_output([sys.executable, '-c', SCRIPT.format(module=module, access=access)])
+        runs.append(json.loads(out.decode('utf-8').strip().splitlines()[-1]))
+    return runs
+
+
+def main():
+    parser = arg_parser('import_time', __doc__)
+    parser.add_argument(
+        '--budget-ms',
+        type=float,
+        default=None,
+        help='Fail if the median import time exceeds this many milliseconds')
+    args = parser.parse_args()
+
+    repeat = 3 if args.quick else 10
+    results = {}
+    failed = False
+
+    runs = measure(repeat=repeat)
+    durations = [r['duration'] for r in runs]
+    results['import/scannertools'] = {
+        'latency_ms': percentile(durations, 50) * 1000,
+        'latency_p95_ms': percentile(durations, 95) * 1000
+    }
+
+    loaded = [m for m in HEAVY_MODULES if m in runs[0]['modules']]
+    if len(loaded) > 0:
+        print('FAIL heavy modules loaded by `import scannertools`: {}'.format(', '.join(loaded)))
+        failed = True
+
+    if args.budget_ms is not None and results['import/scannertools']['latency_ms'] > args.budget_ms:
+        print('FAIL import took {:.1f}ms, budget is {:.1f}ms'.format(
+            results['import/scannertools']['latency_ms'], args.budget_ms))
+        failed = True
+
+    # For reference, the cost of the first access to a pipeline module
+    for name in ['shot_detection', 'vis']:
+        runs = measure(access='scannertools.{}'.format(name), repeat=repeat)
+        durations = [r['duration'] for r in runs]
+        results['import/scannertools.{}'.format(name)] = {
+            'latency_ms': percentile(durations, 50) * 1000
+        }
+
+    finish(args, results)
+
+    if failed:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
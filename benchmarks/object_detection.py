@@ -0,0 +1,77 @@
+"""
+Compares the float and int8-quantized object detection backends on frames of the sample video:
+throughput and latency of each kernel on the CPU, and the precision, recall and box IoU of the
+quantized detections against the float ones. Downloads the sample video and both models on the
+first run. Usage:
+
+    python3 benchmarks/object_detection.py [--quick] [--save-baseline]
+"""
+
+from scannertools import sample_video
+from scannertools.object_detection import DetectObjects, DetectObjectsQuantized, \
+    ObjectDetectionPipeline, QUANTIZED_MODEL, QUANTIZED_MODEL_FILE, MODEL_NAME, \
+    compare_detections
+from scannertools.prelude import BBOX_CODEC
+from common import arg_parser, finish, run_isolated, timed
+from types import SimpleNamespace
+import os
+
+NUM_FRAMES = 64
+BATCH = 8
+
+# Scores above which detections are compared
+MIN_SCORES = [0.3, 0.5]
+
+
+def _frames(num_frames):
+    with sample_video(delete=False) as video:
+        step = max(video.num_frames() // num_frames, 1)
+        return video.frames(list(range(0, video.num_frames(), step))[:num_frames])
+
+
+def bench(backend, num_frames):
+    frames = _frames(num_frames)
+    if backend == 'float':
+        model_dir = ObjectDetectionPipeline.resources['model'].fetch()
+        args = {'graph_path': os.path.join(model_dir, MODEL_NAME, 'frozen_inference_graph.pb')}
+        kernel = DetectObjects(SimpleNamespace(args=args, devices=[], protobufs=None))
+    else:
+        args = {'model_path': os.path.join(QUANTIZED_MODEL.fetch(), QUANTIZED_MODEL_FILE)}
+        kernel = DetectObjectsQuantized(SimpleNamespace(args=args, devices=[], protobufs=None))
+
+    batches = [frames[i:i + BATCH] for i in range(0, len(frames), BATCH)]
+    kernel.execute(batches[0])  # Exclude one-time initialization from the timings
+    outputs = []
+    run = lambda: outputs.append([b for batch in batches for b in kernel.execute(batch)])
+    durations = timed(run)
+    return {
+        'throughput': len(frames) / min(durations),
+        'latency_ms': min(durations) / len(batches) * 1000,
+        'detections': outputs[0]
+    }
+
+
+def main():
+    parser = arg_parser('object_detection', __doc__)
+    args = parser.parse_args()
+
+    num_frames = NUM_FRAMES // 4 if args.quick else NUM_FRAMES
+    results = {}
+    detections = {}
+    for backend in ['float', 'quantized']:
+        results[backend] = run_isolated(bench, backend, num_frames)
+        detections[backend] = [BBOX_CODEC.decode(b) for b in results[backend].pop('detections')]
+
+    for min_score in MIN_SCORES:
+        accuracy = compare_detections(
+            detections['float'], detections['quantized'], min_score=min_score)
+        results['accuracy/score>={}'.format(min_score)] = {
+            k: accuracy[k]
+            for k in ['precision', 'recall', 'mean_iou', 'mean_score_diff']
+        }
+
+    finish(args, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,47 @@
+"""
+Measures the throughput of the CPU optical flow kernel (DISOpticalFlow) at each quality preset
+and common resolutions, with and without upsampling the field back to full resolution. Usage:
+
+    python3 benchmarks/optical_flow.py [--quick] [--save-baseline]
+"""
+
+from scannertools.optical_flow import DISOpticalFlow, FLOW_PRESETS
+from common import arg_parser, finish, run_isolated, timed
+from types import SimpleNamespace
+import numpy as np
+
+# (width, height)
+RESOLUTIONS = [(640, 360), (1280, 720), (1920, 1080)]
+
+
+def _frames(width, height):
+    import cv2
+    rng = np.random.RandomState(0)
+    img = cv2.GaussianBlur((rng.rand(height, width + 8, 3) * 255).astype(np.uint8), (9, 9), 3)
+    return np.ascontiguousarray(img[:, 8:]), np.ascontiguousarray(img[:, :-8])
+
+
+def bench(width, height, preset, upsample):
+    prev, cur = _frames(width, height)
+    kernel = DISOpticalFlow(
+        SimpleNamespace(args={'preset': preset, 'scale': None, 'upsample': upsample}))
+    durations = timed(lambda: kernel.execute([prev, cur]), repeat=10)
+    return {'throughput': 1 / min(durations), 'latency_ms': min(durations) * 1000}
+
+
+def main():
+    parser = arg_parser('optical_flow', __doc__)
+    args = parser.parse_args()
+
+    results = {}
+    for (width, height) in RESOLUTIONS[:1] if args.quick else RESOLUTIONS:
+        for preset in sorted(FLOW_PRESETS.keys()):
+            for upsample in [True, False]:
+                key = '{}/{}x{}{}'.format(preset, width, height, '' if upsample else '_lowres')
+                results[key] = run_isolated(bench, width, height, preset, upsample)
+
+    finish(args, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,166 @@
+"""
+Microbenchmarks for the result decoding and post-processing paths that run after every job:
+shot boundary computation, bbox decoding through ScannerColumn.load and Codec.decode_many,
+BboxNMS, BboxDraw, and decoding of clothing and gender outputs.
+
+Inputs are synthetic, so no Scanner database or models are needed. Usage:
+
+    python3 benchmarks/postprocess.py [--quick] [--save-baseline]
+"""
+
+from scannertools.prelude import ScannerColumn, BBOX_CODEC
+from scannertools.shot_detection import ShotDetectionPipeline
+from scannertools.clothing_detection import parse_clothing, CLOTHING_CODEC
+from scannertools.gender_detection import GENDER_CODEC
+from scannertools.bboxes import BboxNMS
+from scannertools.vis import BboxDraw
+from common import arg_parser, finish, run_isolated, timed, traced
+from types import SimpleNamespace
+import numpy as np
+import tempfile
+
+# Number of rows (boxes, frames or faces, depending on the case) at each scale
+SIZES = {
+    'shot_boundaries': [10**5, 10**6],
+    'bboxes_load': [10**5, 10**6, 10**7],
+    'bboxes_decode_many': [10**5, 10**6, 10**7],
+    'bbox_nms': [10**5, 10**6],
+    'bbox_draw': [10**5],
+    'parse_clothing': [10**5, 10**6],
+    'gender_decode': [10**5, 10**6, 10**7],
+}
+
+BOXES_PER_FRAME = 10
+FACES_PER_FRAME = 3
+
+
+class InMemoryColumn:
+    """
+    Stand-in for a scannerpy Column that serves pre-serialized rows from memory.
+    """
+
+    def __init__(self, rows):
+        self._rows = rows
+
+    def load(self, fn):
+        for buf in self._rows:
+            yield fn(buf, None)
+
+
+def _random_bboxes(rng, n):
+    xy1 = rng.uniform(0, 0.8, size=(n, 2))
+    wh = rng.uniform(0.05, 0.2, size=(n, 2))
+    return BBOX_CODEC.encode_columns(
+        x1=xy1[:, 0],
+        y1=xy1[:, 1],
+        x2=xy1[:, 0] + wh[:, 0],
+        y2=xy1[:, 1] + wh[:, 1],
+        score=rng.uniform(size=n),
+        label=rng.randint(1, 90, size=n))
+
+
+def _bbox_rows(num_boxes, per_frame):
+    rng = np.random.RandomState(0)
+    # Serializing every frame separately is slow at large scales, so reuse a pool of frames
+    pool = [_random_bboxes(rng, per_frame) for _ in range(1000)]
+    return [pool[i % len(pool)] for i in range(num_boxes // per_frame)]
+
+
+def _measure(f, rows, repeat=3):
+    durations = timed(f, repeat=repeat)
+    blocks, peak = traced(f)
+    return {
+        'throughput': rows / min(durations),
+        'latency_ms': min(durations) * 1000,
+        'alloc_blocks': blocks,
+        'alloc_peak_mb': peak
+    }
+
+
+def bench_shot_boundaries(rows):
+    rng = np.random.RandomState(0)
+    base = rng.randint(0, 1000, size=(rows // 300 + 1, 3, 16))
+    noise = rng.randint(0, 20, size=(rows, 3, 16))
+    hists = base[np.arange(rows) // 300] + noise
+    hists = [[h[0], h[1], h[2]] for h in hists]
+    pipeline = ShotDetectionPipeline(None)
+    return _measure(lambda: pipeline._compute_shot_boundaries(hists), rows, repeat=1)
+
+
+def bench_bboxes_load(rows):
+    column = ScannerColumn(InMemoryColumn(_bbox_rows(rows, BOXES_PER_FRAME)), BBOX_CODEC.decode)
+    return _measure(lambda: list(column.load()), rows)
+
+
+def bench_bboxes_decode_many(rows):
+    bufs = _bbox_rows(rows, BOXES_PER_FRAME)
+    return _measure(lambda: BBOX_CODEC.decode_many(bufs), rows)
+
+
+def bench_bbox_nms(rows):
+    # Two input columns, as when merging detections from several models
+    frames = _bbox_rows(rows // 2, BOXES_PER_FRAME)
+    kernel = BboxNMS(SimpleNamespace(args={'threshold': 0.3}, protobufs=None))
+    return _measure(lambda: [kernel.execute(buf, buf) for buf in frames], rows)
+
+
+def bench_bbox_draw(rows):
+    with tempfile.NamedTemporaryFile('w', suffix='.pbtxt') as f:
+        for i in range(1, 91):
+            f.write('item {{\n  name: "/m/{0}"\n  id: {0}\n  display_name: "label"\n}}\n'.format(i))
+        f.flush()
+        kernel = BboxDraw(SimpleNamespace(args={'label_path': f.name}, protobufs=None))
+
+    frame = np.zeros((360, 640, 3), dtype=np.uint8)
+    bufs = _bbox_rows(rows, BOXES_PER_FRAME)
+    return _measure(lambda: [kernel.execute(frame.copy(), buf) for buf in bufs], rows, repeat=1)
+
+
+def bench_parse_clothing(rows):
+    rng = np.random.RandomState(0)
+    shape = (FACES_PER_FRAME, ) + CLOTHING_CODEC.dtype.shape
+    pool = [CLOTHING_CODEC.encode(rng.randint(0, 2, size=shape)) for _ in range(1000)]
+    bufs = [pool[i % len(pool)] for i in range(rows // FACES_PER_FRAME)]
+    return _measure(lambda: [parse_clothing(buf, None) for buf in bufs], rows)
+
+
+def bench_gender_decode(rows):
+    rng = np.random.RandomState(0)
+    pool = [
+        GENDER_CODEC.encode([(rng.randint(2), rng.rand()) for _ in range(FACES_PER_FRAME)])
+        for _ in range(1000)
+    ]
+    bufs = [pool[i % len(pool)] for i in range(rows // FACES_PER_FRAME)]
+    return _measure(lambda: [GENDER_CODEC.decode(buf) for buf in bufs], rows)
+
+
+BENCHMARKS = {
+    'shot_boundaries': bench_shot_boundaries,
+    'bboxes_load': bench_bboxes_load,
+    'bboxes_decode_many': bench_bboxes_decode_many,
+    'bbox_nms': bench_bbox_nms,
+    'bbox_draw': bench_bbox_draw,
+    'parse_clothing': bench_parse_clothing,
+    'gender_decode': bench_gender_decode,
+}
+
+
+def main():
+    parser = arg_parser('postprocess', __doc__)
+    parser.add_argument(
+        '--only', nargs='+', choices=list(BENCHMARKS.keys()), help='Run only these benchmarks')
+    args = parser.parse_args()
+
+    results = {}
+    for name, fn in sorted(BENCHMARKS.items()):
+        if args.only is not None and name not in args.only:
+            continue
+        sizes = SIZES[name][:1] if args.quick else SIZES[name]
+        for rows in sizes:
+            results['{}/{}'.format(name, rows)] = run_isolated(fn, rows)
+
+    finish(args, results)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+"""
+Benchmarks the client-side frame access paths: Video.frames, Video.montage, tile and par_for.
+
+Videos are generated locally with ffmpeg's testsrc, so no network access is needed. Usage:
+
+    python3 benchmarks/video_access.py [--quick] [--save-baseline]
+"""
+
+from scannertools import Video, synthetic_video, tile
+from scannertools.prelude import par_for
+from common import arg_parser, finish, run_isolated, timed, percentile
+import numpy as np
+import random
+
+# (width, height)
+RESOLUTIONS = [(640, 360), (1280, 720), (1920, 1080)]
+GOP_SIZES = [12, 250]
+LENGTHS = [300, 3000]
+
+NUM_FRAMES = 50
+NUM_SINGLE = 20
+
+
+def bench_sequential(path):
+    video = Video(path)
+    video.frame(0)  # Open the decoder outside the timed region
+    numbers = list(range(NUM_FRAMES))
+    durations = timed(lambda: video.frames(numbers))
+    return {'throughput': NUM_FRAMES / min(durations), 'latency_ms': min(durations) * 1000}
+
+
+def bench_strided(path, stride):
+    video = Video(path)
+    video.frame(0)
+    numbers = list(range(0, video.num_frames(), stride))[:NUM_FRAMES]
+    durations = timed(lambda: video.frames(numbers))
+    return {'throughput': len(numbers) / min(durations), 'latency_ms': min(durations) * 1000}
+
+
+def bench_random(path):
+    video = Video(path)
+    video.frame(0)
+    rng = random.Random(0)
+    numbers = [rng.randrange(video.num_frames()) for _ in range(NUM_SINGLE)]
+    durations = [timed(lambda: video.frame(n), repeat=1)[0] for n in numbers]
+    return {
+        'throughput': len(numbers) / sum(durations),
+        'latency_ms': percentile(durations, 50) * 1000,
+        'latency_p95_ms': percentile(durations, 95) * 1000
+    }
+
+
+def bench_montage(path):
+    video = Video(path)
+    video.frame(0)
+    numbers = list(range(0, video.num_frames(), max(video.num_frames() // 25, 1)))[:25]
+    durations = timed(lambda: video.montage(numbers, cols=5))
+    return {'throughput': len(numbers) / min(durations), 'latency_ms': min(durations) * 1000}
+
+
+def bench_tile(width, height):
+    imgs = [np.zeros((height, width, 3), dtype=np.uint8) for _ in range(25)]
+    durations = timed(lambda: tile(list(imgs), cols=5))
+    return {'throughput': len(imgs) / min(durations), 'latency_ms': min(durations) * 1000}
+
+
+def _histogram(arr):
+    return np.histogram(arr, bins=16, range=(0, 256))[0]
+
+
+def bench_par_for(process, shared_memory=False):
+    arrs = [np.random.randint(0, 256, size=(360, 640, 3), dtype=np.uint8) for _ in range(64)]
+    durations = timed(lambda: par_for(
+        _histogram, arrs, process=process, shared_memory=shared_memory, progress=False))
+    return {'throughput': len(arrs) / min(durations), 'latency_ms': min(durations) * 1000}
+
+
+def main():
+    parser = arg_parser('video_access', __doc__)
+    args = parser.parse_args()
+
+    resolutions = RESOLUTIONS[:1] if args.quick else RESOLUTIONS
+    gop_sizes = GOP_SIZES[:1] if args.quick else GOP_SIZES
+    lengths = LENGTHS[:1] if args.quick else LENGTHS
+
+    results = {}
+    for (width, height) in resolutions:
+        results['tile/{}x{}'.format(width, height)] = run_isolated(bench_tile, width, height)
+
+        for gop in gop_sizes:
+            for length in lengths:
+                with synthetic_video(
+                        width=width, height=height, num_frames=length, gop=gop,
+                        delete=False) as video:
+                    key = '{}x{}_g{}_{}f'.format(width, height, gop, length)
+                    path = video.path()
+                    results['sequential/' + key] = run_isolated(bench_sequential, path)
+                    results['strided/' + key] = run_isolated(bench_strided, path, 10)
+                    results['random/' + key] = run_isolated(bench_random, path)
+                    results['montage/' + key] = run_isolated(bench_montage, path)
+
+    results['par_for/thread'] = run_isolated(bench_par_for, False)
+    results['par_for/process'] = run_isolated(bench_par_for, True)
+    results['par_for/process_shm'] = run_isolated(bench_par_for, True, True)
+
+    finish(args, results)
+
+
+if __name__ == '__main__':
+    main()
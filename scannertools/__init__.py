@@ -1,15 +1,36 @@
-from .prelude import WithMany, init_storage, sample_video, imwrite, BoundOp, Pipeline, tile, DataSource
+from .prelude import WithMany, init_storage, sample_video, synthetic_video, imwrite, BoundOp, Pipeline, tile, DataSource
 from .video import Video
 from .audio import Audio
-from . import pose_detection
-from . import shot_detection
-from . import object_detection
-from . import gender_detection
-from . import face_detection
-from . import face_embedding
-from . import optical_flow
-from . import clothing_detection
-from . import tf_vis_utils
-from . import vis
-from . import bboxes
-from . import kube
+import importlib
+import types
+import sys
+
+# Pipeline modules pull in heavy dependencies (cv2, scipy, PIL, TensorFlow) and register Scanner
+# ops when imported, so they are only loaded the first time they're accessed as an attribute,
+# e.g. `scannertools.face_detection`.
+LAZY_SUBMODULES = [
+    'pose_detection', 'shot_detection', 'object_detection', 'gender_detection', 'face_detection',
+    'face_embedding', 'face_index', 'face_clustering', 'optical_flow', 'clothing_detection',
+    'tf_kernel', 'tf_vis_utils', 'vis', 'bboxes', 'kube', 'resources'
+]
+
+# Lazy submodules are left out so `from scannertools import *` doesn't import all of them
+__all__ = [
+    'WithMany', 'init_storage', 'sample_video', 'synthetic_video', 'imwrite', 'BoundOp', 'Pipeline',
+    'tile', 'DataSource', 'Video', 'Audio'
+]
+
+
+# Module-level __getattr__ (PEP 562) needs Python 3.7, so swap in a module subclass instead
+class _LazyModule(types.ModuleType):
+    def __getattr__(self, name):
+        if name in LAZY_SUBMODULES:
+            # import_module sets the attribute on the package, so this only runs once per module
+            return importlib.import_module('.' + name, __name__)
+        raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+    def __dir__(self):
+        return sorted(set(super().__dir__()) | set(LAZY_SUBMODULES))
+
+
+sys.modules[__name__].__class__ = _LazyModule
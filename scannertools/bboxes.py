@@ -1,20 +1,113 @@
+from .prelude import BBOX_CODEC
 import scannerpy
-import scannerpy.stdlib.readers as readers
-import scannerpy.stdlib.writers as writers
-import scannerpy.stdlib.bboxes as bboxes
 from scannerpy.stdlib.util import default
+import numpy as np
+
+
+def bboxes_to_np(bboxes):
+    """
+    Converts decoded bbox records to an (N x 6) array with rows [x1, y1, x2, y2, score, label].
+    """
+    return np.stack([bboxes[k].astype(np.float64) for k in BBOX_CODEC.dtype.names], axis=1) \
+        if len(bboxes) > 0 else np.zeros((0, 6))
+
+
+def _iou(box, others):
+    xx1 = np.maximum(box[0], others[:, 0])
+    yy1 = np.maximum(box[1], others[:, 1])
+    xx2 = np.minimum(box[2], others[:, 2])
+    yy2 = np.minimum(box[3], others[:, 3])
+    inter = np.maximum(xx2 - xx1, 0) * np.maximum(yy2 - yy1, 0)
+    area = (box[2] - box[0]) * (box[3] - box[1])
+    other_areas = (others[:, 2] - others[:, 0]) * (others[:, 3] - others[:, 1])
+    return inter / np.maximum(area + other_areas - inter, 1e-12)
+
+
+def iou_matrix(a, b):
+    """
+    Computes the IoU of every pair of boxes from (N x 4) and (M x 4) arrays of [x1, y1, x2, y2].
+
+    Returns:
+        np.array: (N x M) array of IoUs.
+    """
+    xx1 = np.maximum(a[:, None, 0], b[None, :, 0])
+    yy1 = np.maximum(a[:, None, 1], b[None, :, 1])
+    xx2 = np.minimum(a[:, None, 2], b[None, :, 2])
+    yy2 = np.minimum(a[:, None, 3], b[None, :, 3])
+    inter = np.maximum(xx2 - xx1, 0) * np.maximum(yy2 - yy1, 0)
+    area_a = (a[:, 2] - a[:, 0]) * (a[:, 3] - a[:, 1])
+    area_b = (b[:, 2] - b[:, 0]) * (b[:, 3] - b[:, 1])
+    return inter / np.maximum(area_a[:, None] + area_b[None, :] - inter, 1e-12)
+
+
+def nms(boxes, threshold, class_aware=True, soft=False, sigma=0.5, min_score=0.001):
+    """
+    Non-maximum suppression over an array of boxes.
+
+    Args:
+        boxes (np.array): (N x 6) array with rows [x1, y1, x2, y2, score, label].
+        threshold (float): IoU above which a lower-scoring box is suppressed.
+        class_aware (bool, optional): Only suppress boxes with the same label.
+        soft (bool, optional): Use Gaussian Soft-NMS, which decays the scores of overlapping boxes
+            instead of removing them. threshold is ignored in this case.
+        sigma (float, optional): Soft-NMS Gaussian width.
+        min_score (float, optional): Soft-NMS drops boxes whose decayed score falls below this.
+
+    Returns:
+        (np.array, np.array): Indices of the kept boxes in descending score order, and their
+        scores (which differ from the input scores only with Soft-NMS).
+    """
+
+    if len(boxes) == 0:
+        return np.zeros(0, dtype=np.int64), np.zeros(0)
+
+    coords = boxes[:, :4].astype(np.float64)
+    scores = boxes[:, 4].astype(np.float64)
+
+    if class_aware:
+        # Shift each class into its own disjoint region, so boxes of different classes never
+        # overlap and one pass handles every class
+        offset = coords.max() - coords.min() + 1
+        coords = coords + boxes[:, 5:6] * offset
+
+    keep = []
+    if not soft:
+        order = np.argsort(-scores, kind='mergesort')
+        while len(order) > 0:
+            i = order[0]
+            keep.append(i)
+            rest = order[1:]
+            order = rest[_iou(coords[i], coords[rest]) <= threshold]
+        keep = np.array(keep, dtype=np.int64)
+        return keep, scores[keep]
+    else:
+        idxs = np.arange(len(boxes))
+        kept_scores = []
+        while len(idxs) > 0:
+            j = np.argmax(scores[idxs])
+            i = idxs[j]
+            keep.append(i)
+            kept_scores.append(scores[i])
+            idxs = np.delete(idxs, j)
+            scores[idxs] *= np.exp(-_iou(coords[i], coords[idxs])**2 / sigma)
+            idxs = idxs[scores[idxs] >= min_score]
+        return np.array(keep, dtype=np.int64), np.array(kept_scores)
 
 
 @scannerpy.register_python_op()
 class BboxNMS(scannerpy.Kernel):
     def __init__(self, config):
         self._threshold = default(config.args, 'threshold', 0.3)
+        self._class_aware = default(config.args, 'class_aware', True)
+        self._soft = default(config.args, 'soft', False)
         self._config = config
 
     def execute(self, *input_columns) -> bytes:
-        bboxes_list = []
-        for c in input_columns:
-            bboxes_list += readers.bboxes(c, self._config.protobufs)
+        bboxes = np.concatenate(
+            [BBOX_CODEC.decode(c, self._config.protobufs) for c in input_columns])
+        keep, scores = nms(
+            bboxes_to_np(bboxes), self._threshold, class_aware=self._class_aware, soft=self._soft)
 
-        nmsed_bboxes = bboxes.nms(bboxes_list, self._threshold)
-        return writers.bboxes(nmsed_bboxes, self._config.protobufs)
+        nmsed_bboxes = bboxes[keep]
+        nmsed_bboxes['score'] = scores
+        return BBOX_CODEC.encode(nmsed_bboxes)
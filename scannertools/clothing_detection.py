@@ -1,9 +1,8 @@
-from .prelude import Pipeline, try_import
+from .prelude import Pipeline, try_import, register_codec, BBOX_CODEC
+from .resources import Resource
 from scannerpy import Kernel, FrameType, DeviceType
-from scannerpy.stdlib.util import download_temp_file
-from scannerpy.stdlib import readers
 import scannerpy
-import pickle
+from typing import Sequence
 import sys
 import os
 import numpy as np
@@ -11,6 +10,8 @@ import numpy as np
 MODEL_URL = 'https://storage.googleapis.com/esper/models/clothing/model_newsanchor.tar'
 MODEL_DEF_URL = 'https://raw.githubusercontent.com/sola777/video-analysis/master/streetstyle-classifier/classifier/newsanchor_classifier_model.py'
 
+DEFAULT_BATCH = 8
+
 
 ATTRIBUTES = [
     {
@@ -84,6 +85,9 @@ ATTRIBUTES = [
     }
 ] # yapf: disable
 
+# One record per face, holding the predicted value index of each attribute
+CLOTHING_CODEC = register_codec('clothing', ('u1', (len(ATTRIBUTES), )))
+
 
 class Clothing:
     def __init__(self, predictions):
@@ -122,11 +126,9 @@ class TorchKernel(Kernel):
     def images_to_tensor(self, images):
         import torch
 
-        shape = images[0].shape
-        images_tensor = torch.Tensor(len(images), shape[0], shape[1], shape[2])
-        for i in range(len(images)):
-            images_tensor[i] = images[i]
-        return images_tensor
+        images_tensor = torch.stack(images)
+        # Page-locked memory makes the copy to the GPU faster
+        return images_tensor if self.cpu_only else images_tensor.pin_memory()
 
     def build_model(self):
         import torch
@@ -142,7 +144,7 @@ class TorchKernel(Kernel):
         raise NotImplementedError
 
 
-@scannerpy.register_python_op()
+@scannerpy.register_python_op(batch=DEFAULT_BATCH)
 class DetectClothing(TorchKernel):
     def __init__(self, config):
         from torchvision import transforms
@@ -154,103 +156,123 @@ class DetectClothing(TorchKernel):
             transforms.Normalize([0.485, 0.456, 0.406], [0.229, 0.224, 0.225])
         ])
 
-    def detect_edge_text(self, img, start_y=40):
+    @staticmethod
+    def detect_edge_text(img, start_y=40):
         import cv2
         edges = cv2.Canny(img, 80, 80)
         img_bright = np.max(img, axis=2)
         H, W = img_bright.shape
-        img_bright = img_bright.astype('int')
         BOUNDARY_THRESH = 0.5
         CONTRAST_THRESH = 96
         TEXT_THRESH = 0.45
         HEAD_THRESH = 0.3
         start_y = int((H - start_y) * HEAD_THRESH + start_y)
-        for y in range(start_y, H):
-            ## detect edge
-            find_edge = False
-            find_text = False
-            non_zero = np.count_nonzero(edges[y])
-            if 1. * non_zero / W > BOUNDARY_THRESH:
-                find_edge = True
-            ## find text
-            cnt_grad = 0
-            for x in range(W):
-                grad_horiz = False
-                neighbor = [-2, -1, 1, 2]
-                for i in neighbor:
-                    if x+i < 0 or x+i > W-1:
-                        continue
-                    if np.fabs(img_bright[y, x+i] - img_bright[y, x]) > CONTRAST_THRESH:
-                        grad_horiz = True
-                        break
-                if grad_horiz:
-                    cnt_grad += 1
-            if 1. * cnt_grad / W > TEXT_THRESH:
-                find_text = True
-            if find_edge or find_text:
-                ## too close to head: possibly wearing texture
-                return y
-        return H
-
-    def execute(self, frame: FrameType, bboxes: bytes) -> bytes:
-        from PIL import Image
-        from torch.autograd import Variable
-        import torch
 
-        h, w = frame.shape[:2]
-        bboxes = readers.bboxes(bboxes, self.config.protobufs)
+        # Index with an explicit range so rows are selected exactly as a Python loop over
+        # range(start_y, H) would
+        ys = np.arange(start_y, H)
+        if len(ys) == 0:
+            return H
+        bright = img_bright[ys].astype('int')
+
+        ## detect edge
+        find_edge = 1. * np.count_nonzero(edges[ys], axis=1) / W > BOUNDARY_THRESH
+
+        ## find text: a pixel has a horizontal gradient if any neighbour within 2 pixels differs
+        ## by more than the contrast threshold
+        grad_horiz = np.zeros(bright.shape, dtype=np.bool_)
+        for i in [1, 2]:
+            diff = np.abs(bright[:, i:] - bright[:, :-i]) > CONTRAST_THRESH
+            grad_horiz[:, :-i] |= diff
+            grad_horiz[:, i:] |= diff
+        find_text = 1. * np.count_nonzero(grad_horiz, axis=1) / W > TEXT_THRESH
+
+        ## too close to head: possibly wearing texture
+        found = find_edge | find_text
+        return ys[np.argmax(found)] if found.any() else H
+
+    @staticmethod
+    def body_bounds(bboxes):
+        """
+        For each face, returns the top of the nearest other face that is below it and horizontally
+        overlaps its body (taken to be twice the face width), or 1.0 if there is none.
+        """
         if len(bboxes) == 0:
-            return pickle.dumps([])
-
-        if self.config.args['adjust_bboxes']:
-            images = []
-            for i, bbox in enumerate(bboxes):
-                x1 = int(bbox.x1 * w)
-                y1 = int(bbox.y1 * h)
-                x2 = int(bbox.x2 * w)
-                y2 = int(bbox.y2 * h)
-
-                ## set crop window
-                crop_w = (x2 - x1) * 2
-                crop_h = crop_w * 2
-                X1 = int((x1 + x2) / 2 - crop_w / 2)
-                X2 = X1 + crop_w
-                Y1 = int((y1 + y2) / 2 - crop_h / 3)
-                Y2 = Y1 + crop_h
-
-                ## adjust box size by image boundary
-                crop_x1 = max(0, X1)
-                crop_x2 = min(w-1, X2)
-                crop_y1 = max(0, Y1)
-                crop_y2 = min(h-1, Y2)
-                cropped = frame[crop_y1:crop_y2+1, crop_x1:crop_x2+1, :]
-
-                ## compute body bound
-                body_bound = 1.0
-                for j, other_bbox in enumerate(bboxes):
-                    if i == j:
-                        continue
-                    if bbox.y2 < other_bbox.y1:
-                        center = (bbox.x1  + bbox.x2) / 2
-                        crop_x1 = (center - face.x2 + face.x1)
-                        crop_x2 = (center + face.x2 - face.x1)
-                        if other_bbox.x1 < crop_x2 or other_bbox.x2 > crop_x1:
-                            body_bound = other_bbox.y1
-
-                ## detect edge and text
-                neck_line = y2 - crop_y1
-                body_bound = int(body_bound * h) - crop_y1
-                crop_y = self.detect_edge_text(cropped, neck_line)
-                crop_y = min(crop_y, body_bound)
-                cropped = cropped[:crop_y, :, :]
-
-                images.append(cropped)
-        else:
-            images = [
+            return np.zeros(0)
+
+        [x1, y1, x2, y2] = np.array([[b.x1, b.y1, b.x2, b.y2] for b in bboxes]).T
+        center = (x1 + x2) / 2
+        body_x1 = center - (x2 - x1)
+        body_x2 = center + (x2 - x1)
+
+        # Row i, column j: is face j below face i and overlapping face i's body?
+        below = y2[:, np.newaxis] < y1[np.newaxis, :]
+        overlaps = (x1[np.newaxis, :] < body_x2[:, np.newaxis]) & \
+                   (x2[np.newaxis, :] > body_x1[:, np.newaxis])
+        mask = below & overlaps
+        np.fill_diagonal(mask, False)
+
+        return np.where(mask, y1[np.newaxis, :], 1.0).min(axis=1)
+
+    def crop_bboxes(self, frame, bboxes):
+        h, w = frame.shape[:2]
+
+        if not self.config.args['adjust_bboxes']:
+            return [
                 frame[int(bbox.y1 * h):int(bbox.y2 * h),
                       int(bbox.x1 * w):int(bbox.x2 * w)] for bbox in bboxes
             ]
 
+        images = []
+        body_bounds = self.body_bounds(bboxes)
+        for i, bbox in enumerate(bboxes):
+            x1 = int(bbox.x1 * w)
+            y1 = int(bbox.y1 * h)
+            x2 = int(bbox.x2 * w)
+            y2 = int(bbox.y2 * h)
+
+            ## set crop window
+            crop_w = (x2 - x1) * 2
+            crop_h = crop_w * 2
+            X1 = int((x1 + x2) / 2 - crop_w / 2)
+            X2 = X1 + crop_w
+            Y1 = int((y1 + y2) / 2 - crop_h / 3)
+            Y2 = Y1 + crop_h
+
+            ## adjust box size by image boundary
+            crop_x1 = max(0, X1)
+            crop_x2 = min(w-1, X2)
+            crop_y1 = max(0, Y1)
+            crop_y2 = min(h-1, Y2)
+            cropped = frame[crop_y1:crop_y2+1, crop_x1:crop_x2+1, :]
+
+            ## detect edge and text
+            neck_line = y2 - crop_y1
+            body_bound = int(body_bounds[i] * h) - crop_y1
+            crop_y = self.detect_edge_text(cropped, neck_line)
+            crop_y = min(crop_y, body_bound)
+            cropped = cropped[:crop_y, :, :]
+
+            images.append(cropped)
+
+        return images
+
+    def execute(self, frame: Sequence[FrameType], bboxes: Sequence[bytes]) -> Sequence[bytes]:
+        from PIL import Image
+        from torch.autograd import Variable
+        import torch
+
+        # Gather the crops from every frame in the batch so the model only runs once
+        counts = []
+        images = []
+        for (img, frame_bboxes) in zip(frame, bboxes):
+            frame_bboxes = BBOX_CODEC.decode(frame_bboxes, self.config.protobufs)
+            counts.append(len(frame_bboxes))
+            images.extend(self.crop_bboxes(img, frame_bboxes))
+
+        if len(images) == 0:
+            return [CLOTHING_CODEC.encode([]) for _ in counts]
+
         tensor = self.images_to_tensor([self.transform(Image.fromarray(img)) for img in images])
         var = Variable(tensor if self.cpu_only else tensor.cuda(), requires_grad=False)
         scores, features = self.model(var)
@@ -260,11 +282,16 @@ class DetectClothing(TorchKernel):
             _, predicted = torch.max(attrib_score, 1)
             predicted_attributes[:, i] = predicted.cpu().data.numpy().astype(np.int32)
 
-        return pickle.dumps(predicted_attributes)
+        outputs = []
+        offset = 0
+        for n in counts:
+            outputs.append(CLOTHING_CODEC.encode(predicted_attributes[offset:offset + n]))
+            offset += n
+        return outputs
 
 
 def parse_clothing(s, _proto):
-    predictions = pickle.loads(s)
+    predictions = CLOTHING_CODEC.decode(s)
     return [Clothing(predictions[i, :]) for i in range(len(predictions))]
 
 
@@ -273,15 +300,17 @@ class ClothingDetectionPipeline(Pipeline):
     parser_fn = lambda _: parse_clothing
     additional_sources = ['bboxes']
     run_opts = {'pipeline_instances_per_node': 1}
+    resources = {'model': Resource(MODEL_URL), 'model_def': Resource(MODEL_DEF_URL)}
 
     def fetch_resources(self):
         try_import('torch', __name__)
         try_import('torchvision', __name__)
+        super().fetch_resources()
 
-        self._model_path = download_temp_file(MODEL_URL)
-        self._model_def_path = download_temp_file(MODEL_DEF_URL)
+        self._model_path = self._resource_paths['model']
+        self._model_def_path = self._resource_paths['model_def']
 
-    def build_pipeline(self, adjust_bboxes=True):
+    def build_pipeline(self, adjust_bboxes=True, batch=DEFAULT_BATCH):
         return {
             'clothing':
             self._db.ops.DetectClothing(
@@ -290,7 +319,8 @@ class ClothingDetectionPipeline(Pipeline):
                 model_path=self._model_path,
                 model_def_path=self._model_def_path,
                 model_key='best_model',
-                adjust_bboxes=adjust_bboxes)
+                adjust_bboxes=adjust_bboxes,
+                batch=batch)
         }
 
 
@@ -0,0 +1,160 @@
+from .prelude import *
+from .face_index import nearest_centroids, kmeans
+
+# Cluster id of each face in a row of bboxes
+FACE_CLUSTER_CODEC = register_codec('face_clusters', '<i4')
+
+DEFAULT_BATCH_SIZE = 100000
+
+# Suffix of the names of the tables holding cluster ids, like a Pipeline's job_suffix
+DEFAULT_SUFFIX = 'face_clusters'
+
+
+def _stream_batches(embeddings, batch_size):
+    """
+    Yields (batch_size x D) arrays of embeddings, loading one column at a time.
+    """
+    pending = []
+    size = 0
+    for column in embeddings:
+        for row in column.load():
+            if row is None or len(row) == 0:
+                continue
+            pending.append(row)
+            size += len(row)
+            if size >= batch_size:
+                batch = np.concatenate(pending)
+                for start in range(0, len(batch) - batch_size + 1, batch_size):
+                    yield batch[start:start + batch_size]
+                pending = [batch[len(batch) - len(batch) % batch_size:]]
+                size = len(pending[0])
+    if size > 0:
+        yield np.concatenate(pending)
+
+
+def _assign(batch, centroids, workers):
+    """
+    Assigns a batch to its nearest centroids, splitting it across workers. NumPy releases the GIL
+    during the matrix multiplies, so threads run in parallel.
+    """
+    chunks = np.array_split(batch, max(min(workers, len(batch) // 1024), 1))
+    labels = par_for(
+        lambda chunk: nearest_centroids(chunk, centroids)[0],
+        chunks,
+        workers=workers,
+        progress=False)
+    return np.concatenate(labels)
+
+
+def minibatch_kmeans(embeddings, k, batch_size=DEFAULT_BATCH_SIZE, epochs=3, seed=0,
+                     workers=None):
+    """
+    Clusters face embeddings with mini-batch k-means, streaming them from their columns.
+
+    Centroids are initialized by k-means on the first batch, then every batch moves each
+    centroid towards the mean of its assigned faces with a learning rate that decays with the
+    number of faces assigned to it so far. Centroids which never receive a face are re-seeded
+    from faces in the next batch.
+
+    Args:
+        embeddings (list): Embeddings columns, e.g. the output of face_embedding.embed_faces.
+        k (int): Number of clusters.
+        batch_size (int, optional): Number of faces per batch. Must be at least k.
+        epochs (int, optional): Number of passes over the embeddings.
+        workers (int, optional): Number of threads, defaults to the number of CPUs.
+
+    Returns:
+        np.array: (k x D) cluster centroids.
+    """
+    if batch_size < k:
+        raise Exception('batch_size ({}) must be at least k ({})'.format(batch_size, k))
+    workers = workers or mp.cpu_count()
+    rng = np.random.RandomState(seed)
+    centroids = None
+    counts = np.zeros(k, dtype=np.int64)
+
+    for _ in range(epochs):
+        for batch in _stream_batches(embeddings, batch_size):
+            batch = batch.astype(np.float32)
+            if centroids is None:
+                if len(batch) < k:
+                    raise Exception('Only found {} faces, fewer than k ({})'.format(len(batch), k))
+                centroids = kmeans(batch, k, seed=seed)
+
+            empty = counts == 0
+            if counts.sum() > 0 and empty.any():
+                centroids[empty] = batch[rng.choice(len(batch), empty.sum())]
+
+            labels = _assign(batch, centroids, workers)
+            batch_counts = np.bincount(labels, minlength=k)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, batch)
+            counts += batch_counts
+            updated = batch_counts > 0
+            centroids[updated] += (sums[updated] - batch_counts[updated, None] *
+                                   centroids[updated]) / counts[updated, None]
+
+    if centroids is None:
+        raise Exception('No faces to cluster')
+    return centroids
+
+
+def assign_clusters(db, embeddings, centroids, suffix=DEFAULT_SUFFIX, workers=None):
+    """
+    Writes the nearest cluster of every face to a new Scanner table per video.
+
+    Args:
+        db (Database): Scanner database.
+        embeddings (list): Embeddings columns.
+        centroids (np.array): (k x D) cluster centroids.
+        suffix (str, optional): Suffix of the output table names. Tables from an earlier call with
+            the same suffix are overwritten, so use a different suffix to keep both.
+        workers (int, optional): Number of videos to assign at once, defaults to the number of
+            CPUs.
+
+    Returns:
+        list: Per video, a column with one array of cluster ids per row, aligned with the bboxes
+            the embeddings were computed from. Rows without embeddings (e.g. gated out) load as
+            empty arrays.
+    """
+
+    def assign(column):
+        return [[
+            FACE_CLUSTER_CODEC.encode(
+                nearest_centroids(row, centroids)[0] if row is not None and len(row) > 0 else [])
+        ] for row in column.load()]
+
+    # Assignments are computed in parallel, but tables are created one at a time as they finish
+    columns = []
+    for (i, rows) in enumerate(par_for_iter(assign, embeddings, workers=workers)):
+        table = db.new_table('{}_{}'.format(i, suffix), ['clusters'], rows, force=True)
+        columns.append(ScannerColumn(table.column('clusters'), FACE_CLUSTER_CODEC.decode))
+    return columns
+
+
+def cluster_faces(db,
+                  embeddings,
+                  k,
+                  batch_size=DEFAULT_BATCH_SIZE,
+                  epochs=3,
+                  suffix=DEFAULT_SUFFIX,
+                  workers=None):
+    """
+    Clusters the faces of many videos, e.g. to find recurring people.
+
+    Embeddings are streamed one column at a time, so only a batch of faces is in memory at
+    once. See minibatch_kmeans and assign_clusters.
+
+    Args:
+        db (Database): Scanner database.
+        embeddings (list): Embeddings columns, e.g. the output of face_embedding.embed_faces.
+        k (int): Number of clusters.
+        suffix (str, optional): Suffix of the output table names, see assign_clusters.
+
+    Returns:
+        (list, np.array): Per video, a column of cluster ids aligned with the bboxes, and the
+            (k x D) cluster centroids.
+    """
+    centroids = minibatch_kmeans(
+        embeddings, k, batch_size=batch_size, epochs=epochs, workers=workers)
+    return assign_clusters(db, embeddings, centroids, suffix=suffix, workers=workers), centroids
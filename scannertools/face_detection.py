@@ -1,88 +1,214 @@
 from .prelude import *
-from scannerpy.stdlib.tensorflow import TensorFlowKernel
-from typing import List
+from .tf_kernel import SharedTensorFlowKernel
+from typing import Sequence
 import os.path
 
 
-@scannerpy.register_python_op(name='MTCNNDetectFacesCPU', device_type=DeviceType.CPU)
-@scannerpy.register_python_op(name='MTCNNDetectFacesGPU', device_type=DeviceType.GPU)
-class MTCNNDetectFaces(TensorFlowKernel):
+# MTCNN detection parameters
+THRESHOLD = [0.45, 0.6, 0.7]
+FACTOR = 0.709
+VMARGIN = 0.2582651235637604
+HMARGIN = 0.3449094129917718
+DETECTION_WINDOW_SIZE_RATIO = .2
+MIN_CONFIDENCE = .1
+
+DEFAULT_BATCH = 8
+
+# Input sizes of the P-Net, R-Net and O-Net stages, used to warm them up when they're loaded
+NET_INPUT_SIZES = [12, 24, 48]
+
+# Tracking parameters for mode='track'. A face is tracked by following corner points inside its
+# box with Lucas-Kanade flow, and the frame is re-detected if fewer than TRACK_MIN_CONFIDENCE of
+# a face's points are tracked consistently forwards and backwards.
+DEFAULT_DETECT_EVERY = 8
+TRACK_MAX_POINTS = 30
+TRACK_MIN_POINTS = 4
+TRACK_MIN_CONFIDENCE = 0.5
+TRACK_MAX_ERROR = 1.0
+
+
+@scannerpy.register_python_op(
+    name='MTCNNDetectFacesCPU', device_type=DeviceType.CPU, batch=DEFAULT_BATCH)
+@scannerpy.register_python_op(
+    name='MTCNNDetectFacesGPU', device_type=DeviceType.GPU, batch=DEFAULT_BATCH)
+class MTCNNDetectFaces(SharedTensorFlowKernel):
+    model_name = 'mtcnn'
+
     def build_graph(self):
         import tensorflow as tf
-        self.pnet = None
-        self.g = tf.Graph()
-        self._g_default = self.g.as_default()
-        return self.g
+        return tf.Graph()
 
-    def execute(self, frame: FrameType) -> bytes:
+    def load_model(self):
         import align.detect_face
+        return align.detect_face.create_mtcnn(self.sess, self.config.args['model_dir'])
+
+    def warm_up(self):
+        # Run each stage directly at its input size, since a blank frame wouldn't produce any
+        # candidates for the later stages
+        for (net, size) in zip(self.model, NET_INPUT_SIZES):
+            net(np.zeros((1, size, size, 3), dtype=np.float32))
 
-        if self.pnet is None:
-            with self.g.as_default():
-                with self.sess.as_default():
-                    print('Loading model...')
-                    self.pnet, self.rnet, self.onet = align.detect_face.create_mtcnn(
-                        self.sess, self.config.args['model_dir'])
-                    print('Model loaded!')
-
-        threshold = [0.45, 0.6, 0.7]
-        factor = 0.709
-        vmargin = 0.2582651235637604
-        hmargin = 0.3449094129917718
-        out_size = 160
-        detection_window_size_ratio = .2
-
-        imgs = [frame]
-        #print(('Face detect on {} frames'.format(len(imgs))))
-        detections = align.detect_face.bulk_detect_face(
-            imgs, detection_window_size_ratio, self.pnet, self.rnet, self.onet, threshold, factor)
-
-        batch_faces = []
-        for img, bounding_boxes in zip(imgs, detections):
-            if bounding_boxes == None:
-                batch_faces.append([])
-                continue
-            frame_faces = []
-            bounding_boxes = bounding_boxes[0]
-            num_faces = bounding_boxes.shape[0]
-            for i in range(num_faces):
-                confidence = bounding_boxes[i][4]
-                if confidence < .1:
-                    continue
-
-                img_size = np.asarray(img.shape)[0:2]
-                det = np.squeeze(bounding_boxes[i][0:5])
-                vmargin_pix = int((det[2] - det[0]) * vmargin)
-                hmargin_pix = int((det[3] - det[1]) * hmargin)
-                frame_faces.append(
-                    self.config.protobufs.BoundingBox(
-                        x1=np.maximum(det[0] - hmargin_pix / 2, 0) / img_size[1],
-                        y1=np.maximum(det[1] - vmargin_pix / 2, 0) / img_size[0],
-                        x2=np.minimum(det[2] + hmargin_pix / 2, img_size[1]) / img_size[1],
-                        y2=np.minimum(det[3] + vmargin_pix / 2, img_size[0]) / img_size[0],
-                        score=det[4]))
-
-            batch_faces.append(frame_faces)
-
-        return writers.bboxes(batch_faces[0], self.config.protobufs)
+    def _detect(self, imgs):
+        import align.detect_face
+
+        (pnet, rnet, onet) = self.model
+        return align.detect_face.bulk_detect_face(imgs, DETECTION_WINDOW_SIZE_RATIO, pnet, rnet,
+                                                  onet, THRESHOLD, FACTOR)
+
+    def execute(self, frame: Sequence[FrameType]) -> Sequence[bytes]:
+        # Run the detector once over the whole batch of frames
+        imgs = frame
+        detections = self._detect(imgs)
+
+        return [
+            self._encode_bboxes(img, bounding_boxes)
+            for img, bounding_boxes in zip(imgs, detections)
+        ]
+
+    def _encode_bboxes(self, img, bounding_boxes):
+        if bounding_boxes is None:
+            return BBOX_CODEC.encode([])
+
+        dets = bounding_boxes[0]
+        dets = dets[dets[:, 4] >= MIN_CONFIDENCE]
+
+        [h, w] = img.shape[:2]
+        vmargin_pix = ((dets[:, 2] - dets[:, 0]) * VMARGIN).astype(np.int64)
+        hmargin_pix = ((dets[:, 3] - dets[:, 1]) * HMARGIN).astype(np.int64)
+        x1 = np.maximum(dets[:, 0] - hmargin_pix / 2, 0) / w
+        y1 = np.maximum(dets[:, 1] - vmargin_pix / 2, 0) / h
+        x2 = np.minimum(dets[:, 2] + hmargin_pix / 2, w) / w
+        y2 = np.minimum(dets[:, 3] + vmargin_pix / 2, h) / h
+
+        return BBOX_CODEC.encode_columns(x1=x1, y1=y1, x2=x2, y2=y2, score=dets[:, 4])
+
+
+@scannerpy.register_python_op(
+    name='MTCNNTrackFacesCPU', device_type=DeviceType.CPU, batch=DEFAULT_BATCH,
+    unbounded_state=True)
+@scannerpy.register_python_op(
+    name='MTCNNTrackFacesGPU', device_type=DeviceType.GPU, batch=DEFAULT_BATCH,
+    unbounded_state=True)
+class MTCNNTrackFaces(MTCNNDetectFaces):
+    """
+    Runs MTCNN every detect_every frames and tracks the detected faces in between. Frames are
+    processed in order, since whether a frame needs detection depends on tracking the previous
+    one. The op is registered with unbounded state, so Scanner calls reset at the start of every
+    video and whenever it skips rows, and each run of frames starts with a detection.
+    """
+
+    def __init__(self, config):
+        super().__init__(config)
+        self.reset()
+
+    def reset(self):
+        self._since_detection = None
+        self._prev_gray = None
+        self._dets = None
+
+    def _track(self, prev_gray, gray, dets):
+        """
+        Moves each box by the median flow of the points tracked inside it. Returns None if any
+        face can't be tracked confidently.
+        """
+        import cv2
+
+        [h, w] = gray.shape
+        points = []
+        owners = []
+        for (i, det) in enumerate(dets):
+            x1, y1 = max(int(det[0]), 0), max(int(det[1]), 0)
+            x2, y2 = min(int(det[2]), w), min(int(det[3]), h)
+            if x2 - x1 < 2 or y2 - y1 < 2:
+                return None
+            corners = cv2.goodFeaturesToTrack(
+                prev_gray[y1:y2, x1:x2], TRACK_MAX_POINTS, qualityLevel=0.01, minDistance=2)
+            if corners is None or len(corners) < TRACK_MIN_POINTS:
+                return None
+            points.append(corners.reshape((-1, 2)) + [x1, y1])
+            owners.append(np.full(len(corners), i))
+        points = np.concatenate(points).astype(np.float32)
+        owners = np.concatenate(owners)
+
+        # Track all faces' points in one forward and one backward pass
+        forward, status, _ = cv2.calcOpticalFlowPyrLK(prev_gray, gray, points, None)
+        backward, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, prev_gray, forward, None)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & \
+            (np.linalg.norm(backward - points, axis=1) < TRACK_MAX_ERROR)
+
+        tracked = dets.copy()
+        for i in range(len(dets)):
+            mine = owners == i
+            if good[mine].mean() < TRACK_MIN_CONFIDENCE:
+                return None
+            [dx, dy] = np.median(forward[mine & good] - points[mine & good], axis=0)
+            tracked[i, :4] += [dx, dy, dx, dy]
+        return tracked
+
+    def execute(self, frame: Sequence[FrameType]) -> Sequence[bytes]:
+        import cv2
+
+        outputs = []
+        for img in frame:
+            gray = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
+
+            # Never track across a change of frame size, e.g. if frames of another video arrive
+            # without a reset
+            dets = None
+            if self._since_detection is not None and \
+               self._since_detection < self.config.args['detect_every'] and \
+               self._prev_gray.shape == gray.shape:
+                dets = self._track(self._prev_gray, gray, self._dets) \
+                    if len(self._dets) > 0 else self._dets
+
+            if dets is None:
+                detection = self._detect([img])[0]
+                dets = detection[0] if detection is not None else np.zeros((0, 5))
+                dets = dets[dets[:, 4] >= MIN_CONFIDENCE]
+                self._since_detection = 0
+
+            self._since_detection += 1
+            self._prev_gray = gray
+            self._dets = dets
+            outputs.append(self._encode_bboxes(img, (dets, )))
+        return outputs
 
 
 class FaceDetectionPipeline(Pipeline):
     job_suffix = 'face'
-    parser_fn = lambda _: readers.bboxes
+    parser_fn = lambda _: BBOX_CODEC.decode
     run_opts = {'pipeline_instances_per_node': 1}
 
     def fetch_resources(self):
         try_import('align.detect_face', __name__)
         try_import('tensorflow', __name__)
 
-    def build_pipeline(self):
+    def build_pipeline(self,
+                       batch=DEFAULT_BATCH,
+                       mode='detect',
+                       detect_every=DEFAULT_DETECT_EVERY):
+        """
+        With mode='track', full detection only runs every detect_every frames, and faces are
+        tracked in between. Frames where tracking fails are re-detected.
+        """
         import align
+        device = 'GPU' if self._db.has_gpu() else 'CPU'
+        args = {}
+        if mode == 'detect':
+            op = 'MTCNNDetectFaces' + device
+        elif mode == 'track':
+            try_import('cv2', __name__)
+            op = 'MTCNNTrackFaces' + device
+            args['detect_every'] = detect_every
+        else:
+            raise Exception('Invalid face detection mode "{}"'.format(mode))
+
         return {
             'bboxes':
-            getattr(self._db.ops, 'MTCNNDetectFaces{}'.format('GPU' if self._db.has_gpu() else 'CPU'))(
+            getattr(self._db.ops, op)(
                 frame=self._sources['frame_sampled'].op, model_dir=os.path.dirname(align.__file__),
-                device=DeviceType.GPU if self._db.has_gpu() else DeviceType.CPU)
+                device=DeviceType.GPU if self._db.has_gpu() else DeviceType.CPU,
+                batch=batch, **args)
         }
 
 
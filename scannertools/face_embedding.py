@@ -1,89 +1,339 @@
-from .prelude import Pipeline, try_import
+from .prelude import Pipeline, DataSource, ScannerColumn, try_import, register_codec, gate_rows, \
+    BBOX_CODEC
+from .resources import Resource
+from .bboxes import iou_matrix
 from scannerpy import FrameType, DeviceType
 import scannerpy
-from scannerpy.stdlib.util import download_temp_file
-from scannerpy.stdlib import readers
-from scannerpy.stdlib.tensorflow import TensorFlowKernel
+from .tf_kernel import SharedTensorFlowKernel
+from typing import Sequence
 import os
 import numpy as np
 
 MODEL_FILE = 'https://storage.googleapis.com/esper/models/facenet/20170512-110547.tar.gz'
 
 
-@scannerpy.register_python_op(name='EmbedFacesCPU', device_type=DeviceType.CPU)
-@scannerpy.register_python_op(name='EmbedFacesGPU', device_type=DeviceType.GPU)
-class EmbedFaces(TensorFlowKernel):
+EMBEDDING_SIZE = 128
+FACE_SIZE = 160
+
+DEFAULT_BATCH = 8
+
+EMBEDDING_CODEC = register_codec('embeddings', ('<f4', (EMBEDDING_SIZE, )))
+
+# Embeddings of representative crops when embedding per track, with the sharpness (variance of
+# the Laplacian) of each crop used to weight it in the track embedding
+TRACK_EMBEDDING_CODEC = register_codec(
+    'track_embeddings', [('embedding', '<f4', (EMBEDDING_SIZE, )), ('sharpness', '<f4')])
+
+# Minimum IoU between boxes in consecutive frames for them to belong to the same track
+TRACK_IOU = 0.5
+
+
+def _coords(bboxes):
+    if bboxes is None or len(bboxes) == 0:
+        return np.zeros((0, 4))
+    return np.stack([bboxes.x1, bboxes.y1, bboxes.x2, bboxes.y2], axis=1).astype(np.float64)
+
+
+def group_tracks(all_bboxes, iou_threshold=TRACK_IOU):
+    """
+    Links boxes in consecutive rows into tracks, greedily matching the most overlapping pairs.
+
+    Args:
+        all_bboxes (list): Decoded bboxes of each row.
+        iou_threshold (float, optional): Minimum IoU for a box to continue a track.
+
+    Returns:
+        (list, int): Per row, an array with the track id of each box, and the number of tracks.
+    """
+    all_ids = []
+    num_tracks = 0
+    prev = np.zeros((0, 4))
+    prev_ids = np.zeros(0, dtype=np.int64)
+    for bboxes in all_bboxes:
+        # Rows that were not computed (e.g. gated out) don't break tracks
+        if bboxes is None:
+            all_ids.append(np.zeros(0, dtype=np.int64))
+            continue
+
+        coords = _coords(bboxes)
+        ids = np.full(len(coords), -1, dtype=np.int64)
+        if len(coords) > 0 and len(prev) > 0:
+            iou = iou_matrix(coords, prev)
+            used = np.zeros(len(prev), dtype=np.bool_)
+            for flat in np.argsort(-iou, axis=None, kind='mergesort'):
+                (i, j) = divmod(int(flat), len(prev))
+                if iou[i, j] < iou_threshold:
+                    break
+                if ids[i] == -1 and not used[j]:
+                    ids[i] = prev_ids[j]
+                    used[j] = True
+        new = ids == -1
+        ids[new] = np.arange(num_tracks, num_tracks + new.sum())
+        num_tracks += int(new.sum())
+        all_ids.append(ids)
+        (prev, prev_ids) = (coords, ids)
+    return all_ids, num_tracks
+
+
+def track_representatives(all_bboxes, track_ids, num_tracks, k):
+    """
+    Picks up to k boxes per track, preferring large, high-scoring boxes.
+
+    Returns:
+        (np.array, np.array, np.array): Row, index within the row, and track of each chosen box,
+        sorted by row.
+    """
+    if num_tracks == 0:
+        return (np.zeros(0, dtype=np.int64), ) * 3
+    rows = np.concatenate(
+        [np.full(len(ids), r, dtype=np.int64) for (r, ids) in enumerate(track_ids)])
+    idxs = np.concatenate([np.arange(len(ids)) for ids in track_ids])
+    tracks = np.concatenate(track_ids)
+    coords = np.concatenate([_coords(b) for b in all_bboxes])
+    scores = np.concatenate([b.score for b in all_bboxes if b is not None and len(b) > 0])
+    quality = (coords[:, 2] - coords[:, 0]) * (coords[:, 3] - coords[:, 1]) * scores
+
+    # Rank the boxes of each track by quality and keep the first k
+    order = np.lexsort((-quality, tracks))
+    rank = np.arange(len(order)) - np.searchsorted(tracks[order], tracks[order])
+    chosen = np.sort(order[rank < k])
+    return rows[chosen], idxs[chosen], tracks[chosen]
+
+
+class TrackEmbeddings(DataSource):
+    """
+    Face embeddings computed once per track. Loads like an embeddings column, with one array of
+    embeddings per row aligned with the bboxes, where every face shares its track's embedding.
+
+    Attributes:
+        embeddings (np.array): (num_tracks x EMBEDDING_SIZE) array of track embeddings.
+        track_ids (list): Per row, an array with the track id of each face, or None for rows
+            that were gated out.
+    """
+
+    def __init__(self, embeddings, track_ids):
+        self.embeddings = embeddings
+        self.track_ids = track_ids
+
+    def load(self):
+        for ids in self.track_ids:
+            yield self.embeddings[ids] if ids is not None else None
+
+    def scanner_source(self, db):
+        raise Exception('Track embeddings cannot be used as Scanner sources')
+
+    def scanner_args(self, db):
+        raise Exception('Track embeddings cannot be used as Scanner sources')
+
+
+@scannerpy.register_python_op(name='EmbedFacesCPU', device_type=DeviceType.CPU, batch=DEFAULT_BATCH)
+@scannerpy.register_python_op(name='EmbedFacesGPU', device_type=DeviceType.GPU, batch=DEFAULT_BATCH)
+class EmbedFaces(SharedTensorFlowKernel):
+    model_name = 'facenet'
+
     def build_graph(self):
         import tensorflow as tf
-        self.images_placeholder = None
-        self.g = tf.Graph()
-        self._g_default = self.g.as_default()
-        return self.g
+        return tf.Graph()
 
-    def execute(self, frame: FrameType, bboxes: bytes) -> bytes:
+    def load_model(self):
         import facenet
-        import cv2
         import tensorflow as tf
 
-        if self.images_placeholder is None:
-            print('Loading model...')
-            with self.g.as_default():
-                with self.sess.as_default():
-                    model_path = self.config.args['model_dir']
-                    meta_file, ckpt_file = facenet.get_model_filenames(model_path)
-                    saver = tf.train.import_meta_graph(os.path.join(model_path, meta_file))
-                    saver.restore(self.sess, os.path.join(model_path, ckpt_file))
-
-                    self.images_placeholder = tf.get_default_graph().get_tensor_by_name('input:0')
-                    self.embeddings = tf.get_default_graph().get_tensor_by_name('embeddings:0')
-                    self.phase_train_placeholder = tf.get_default_graph().get_tensor_by_name('phase_train:0')
-            print('Model loaded!')
-
-        [h, w] = frame.shape[:2]
-
-        out_size = 160
-        bboxes = readers.bboxes(bboxes, self.config.protobufs)
-        outputs = b''
-        for bbox in bboxes:
-            # NOTE: if using output of mtcnn, not-normalized, so removing de-normalization factors here
-            face_img = frame[int(bbox.y1*h):int(bbox.y2*h), int(bbox.x1*w):int(bbox.x2*w)]
-            [fh, fw] = face_img.shape[:2]
-            if fh == 0 or fw == 0:
-                outputs += np.zeros(128, dtype=np.float32).tobytes()
-            else:
-                face_img = cv2.resize(face_img, (out_size, out_size))
-                face_img = facenet.prewhiten(face_img)
-                embs = self.sess.run(
-                    self.embeddings,
-                    feed_dict={
-                        self.images_placeholder: [face_img],
-                        self.phase_train_placeholder: False
-                    })
+        model_path = self.config.args['model_dir']
+        meta_file, ckpt_file = facenet.get_model_filenames(model_path)
+        saver = tf.train.import_meta_graph(os.path.join(model_path, meta_file))
+        saver.restore(self.sess, os.path.join(model_path, ckpt_file))
+        return {
+            name: self.graph.get_tensor_by_name(name + ':0')
+            for name in ['input', 'embeddings', 'phase_train']
+        }
 
-                outputs += embs[0].tobytes()
+    def warm_up(self):
+        self._embed(np.zeros((1, FACE_SIZE, FACE_SIZE, 3), dtype=np.float32))
 
-        return ' ' if outputs == b'' else outputs
+    def _embed(self, faces):
+        return self.sess.run(
+            self.model['embeddings'],
+            feed_dict={
+                self.model['input']: faces,
+                self.model['phase_train']: False
+            })
+
+    def execute(self, frame: Sequence[FrameType], bboxes: Sequence[bytes]) -> Sequence[bytes]:
+        import facenet
+        import cv2
+
+        frames = frame
+        bboxes = [BBOX_CODEC.decode(b, self.config.protobufs) for b in bboxes]
+        counts = [len(frame_bboxes) for frame_bboxes in bboxes]
+
+        # Gather the crops from every frame in the batch so the model only runs once. Empty crops
+        # are skipped and keep a zero embedding.
+        faces = np.empty((sum(counts), FACE_SIZE, FACE_SIZE, 3), dtype=np.float32)
+        valid = np.zeros(len(faces), dtype=np.bool_)
+        sharpness = np.zeros(len(faces), dtype=np.float32)
+        k = 0
+        for (frame, frame_bboxes) in zip(frames, bboxes):
+            [h, w] = frame.shape[:2]
+            for bbox in frame_bboxes:
+                # NOTE: if using output of mtcnn, not-normalized, so removing de-normalization factors here
+                face_img = frame[int(bbox.y1*h):int(bbox.y2*h), int(bbox.x1*w):int(bbox.x2*w)]
+                [fh, fw] = face_img.shape[:2]
+                if fh > 0 and fw > 0:
+                    if self.config.args.get('sharpness', False):
+                        sharpness[k] = cv2.Laplacian(
+                            cv2.cvtColor(face_img, cv2.COLOR_RGB2GRAY), cv2.CV_32F).var()
+                    face_img = cv2.resize(face_img, (FACE_SIZE, FACE_SIZE))
+                    faces[k] = facenet.prewhiten(face_img)
+                    valid[k] = True
+                k += 1
+
+        embs = np.zeros((len(faces), EMBEDDING_SIZE), dtype=np.float32)
+        if valid.any():
+            embs[valid] = self._embed(faces[valid])
+
+        outputs = []
+        offset = 0
+        for n in counts:
+            if self.config.args.get('sharpness', False):
+                outputs.append(
+                    TRACK_EMBEDDING_CODEC.encode_columns(
+                        embedding=embs[offset:offset + n],
+                        sharpness=sharpness[offset:offset + n]))
+            else:
+                outputs.append(EMBEDDING_CODEC.encode(embs[offset:offset + n]))
+            offset += n
+        return outputs
 
 
 class FaceEmbeddingPipeline(Pipeline):
+    """
+    Computes a FaceNet embedding for each face.
+
+    With per_track=K, faces are linked into tracks across consecutive frames by IoU, and only the
+    K largest, highest-scoring faces of each track are embedded. Their embeddings are averaged,
+    weighted by sharpness, into one embedding per track, which is shared by every face in it.
+    """
+
     job_suffix = 'embed'
-    parser_fn = lambda _: readers.array(np.float32, size=128)
+    parser_fn = lambda self: \
+        TRACK_EMBEDDING_CODEC.decode if self._per_track else EMBEDDING_CODEC.decode
+    _per_track = None
     run_opts = {'pipeline_instances_per_node': 1}
     additional_sources = ['bboxes']
+    resources = {'model': Resource(MODEL_FILE, untar=True)}
 
     def fetch_resources(self):
         try_import('facenet', __name__)
         try_import('tensorflow', __name__)
-        self._model_dir = download_temp_file(MODEL_FILE, untar=True) + '/20170512-110547'
+        super().fetch_resources()
+        self._model_dir = self._resource_paths['model'] + '/20170512-110547'
+
+    def build_sources(self,
+                      videos=None,
+                      frames=None,
+                      bboxes=None,
+                      per_track=None,
+                      track_iou=TRACK_IOU,
+                      gate=None,
+                      gate_min_score=0.0,
+                      gate_labels=None,
+                      **kwargs):
+        """
+        With per_track and a gate, rows that fail the gate are left out of the tracks, so
+        representatives only come from rows that pass it, and those rows load as None.
+        """
+        self._per_track = per_track
+        if per_track is None:
+            return super().build_sources(
+                videos=videos,
+                frames=frames,
+                bboxes=bboxes,
+                gate=gate,
+                gate_min_score=gate_min_score,
+                gate_labels=gate_labels,
+                **kwargs)
+        if frames is not None and not isinstance(frames, list):
+            raise Exception('per_track can only be combined with frames given as a list')
+        if gate is True:
+            gate = bboxes
+
+        # Only gather the frames holding a representative face, with a bboxes column containing
+        # just the representatives. Videos without any tracks are not run.
+        self._tracks = []
+        rep_videos = []
+        rep_frames = []
+        rep_bboxes = []
+        for (i, column) in enumerate(bboxes):
+            all_bboxes = list(column.load())
+            if gate is not None:
+                (passed, num_rows) = gate_rows(gate[i], gate_min_score, gate_labels)
+                if num_rows != len(all_bboxes):
+                    raise Exception('Gate has {} rows, but bboxes have {}'.format(
+                        num_rows, len(all_bboxes)))
+                passed = set(passed)
+                all_bboxes = [b if r in passed else None for (r, b) in enumerate(all_bboxes)]
+            track_ids, num_tracks = group_tracks(all_bboxes, track_iou)
+            rows, idxs, tracks = track_representatives(all_bboxes, track_ids, num_tracks, per_track)
+            if gate is not None:
+                track_ids = [
+                    ids if b is not None else None for (ids, b) in zip(track_ids, all_bboxes)
+                ]
+            self._tracks.append((track_ids, num_tracks, tracks))
+            if len(rows) == 0:
+                continue
+
+            frame_rows = sorted(set(rows.tolist()))
+            table = self._db.new_table(
+                '{}_{}_track_bboxes'.format(i, self.job_suffix), ['bboxes'],
+                [[BBOX_CODEC.encode(all_bboxes[r][idxs[rows == r]])] for r in frame_rows],
+                force=True)
+            rep_videos.append(videos[i])
+            rep_bboxes.append(ScannerColumn(table.column('bboxes'), BBOX_CODEC.decode))
+            rep_frames.append([frames[i][r] if frames is not None else r for r in frame_rows])
+
+        return super().build_sources(
+            videos=rep_videos, frames=rep_frames, bboxes=rep_bboxes, **kwargs)
+
+    def _track_embeddings(self, column, tracks):
+        track_ids, num_tracks, rep_tracks = tracks
+        reps = np.concatenate([np.zeros(0, dtype=TRACK_EMBEDDING_CODEC.dtype)] +
+                              [np.asarray(r) for r in column.load()])
+        weights = reps['sharpness'].astype(np.float64) + 1e-6
+        embeddings = np.zeros((num_tracks, EMBEDDING_SIZE))
+        np.add.at(embeddings, rep_tracks, reps['embedding'] * weights[:, None])
+        norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = (embeddings / np.maximum(norms, 1e-12)).astype(np.float32)
+        return TrackEmbeddings(embeddings, track_ids)
+
+    def execute(self, **kwargs):
+        outputs = super().execute(**kwargs)
+        if self._per_track is None:
+            return outputs
+
+        # Only videos with tracks were run, the others have no faces to embed
+        outputs = iter(outputs)
+        embeddings = []
+        for tracks in self._tracks:
+            if len(tracks[2]) == 0:
+                embeddings.append(
+                    TrackEmbeddings(np.zeros((0, EMBEDDING_SIZE), dtype=np.float32), tracks[0]))
+                continue
+            column = next(outputs)
+            embeddings.append(
+                self._track_embeddings(column, tracks) if column is not None else None)
+        return embeddings
 
-    def build_pipeline(self):
+    def build_pipeline(self, batch=DEFAULT_BATCH):
         return {
             'embeddings':
             getattr(self._db.ops, 'EmbedFaces{}'.format('GPU' if self._db.has_gpu() else 'CPU'))(
                 frame=self._sources['frame_sampled'].op,
                 bboxes=self._sources['bboxes'].op,
                 model_dir=self._model_dir,
-                device=DeviceType.GPU if self._db.has_gpu() else DeviceType.CPU)
+                sharpness=self._per_track is not None,
+                device=DeviceType.GPU if self._db.has_gpu() else DeviceType.CPU,
+                batch=batch)
         }
 
 
@@ -0,0 +1,346 @@
+from .prelude import par_for
+from attr import attrs, attrib
+import numpy as np
+import json
+import os
+
+# Vectors are processed in blocks of this many rows, to bound the memory of the distance matrices
+BLOCK_SIZE = 1 << 16
+
+STORAGES = ['float32', 'float16', 'pq']
+
+# Identifies the face behind each vector: an index into the index's list of videos, the frame
+# number, and the index of the bbox within the frame
+ID_DTYPE = np.dtype([('video', '<i4'), ('frame', '<i8'), ('bbox', '<i4')])
+
+PQ_CENTROIDS = 256
+
+
+@attrs(frozen=True)
+class FaceMatch:
+    video = attrib()
+    frame = attrib()
+    bbox = attrib()
+    distance = attrib()
+
+
+def nearest_centroids(x, centroids, block_size=BLOCK_SIZE):
+    """
+    Finds the nearest centroid (by L2 distance) of each row of x, in blocks of rows.
+
+    Returns:
+        (np.array, np.array): Index of the nearest centroid of each row, and the squared distance.
+    """
+    centroid_norms = (centroids.astype(np.float32)**2).sum(axis=1)
+    labels = np.empty(len(x), dtype=np.int64)
+    distances = np.empty(len(x), dtype=np.float32)
+    for start in range(0, len(x), block_size):
+        block = np.asarray(x[start:start + block_size], dtype=np.float32)
+        # |x - c|^2 = |x|^2 - 2x.c + |c|^2, where |x|^2 doesn't change the argmin
+        d = centroid_norms[None, :] - 2 * block.dot(centroids.T.astype(np.float32))
+        labels[start:start + len(block)] = np.argmin(d, axis=1)
+        distances[start:start + len(block)] = np.maximum(
+            d[np.arange(len(block)), labels[start:start + len(block)]] + (block**2).sum(axis=1), 0)
+    return labels, distances
+
+
+def kmeans(x, k, iterations=20, seed=0):
+    """
+    Lloyd's k-means with blocked assignment, initialized with k-means++. Empty clusters are
+    re-seeded from random points.
+
+    Returns:
+        np.array: (k x D) centroids.
+    """
+    rng = np.random.RandomState(seed)
+    x = np.asarray(x, dtype=np.float32)
+
+    # k-means++: each centroid is sampled with probability proportional to its squared distance
+    # from the nearest centroid chosen so far
+    centroids = np.empty((k, x.shape[1]), dtype=np.float32)
+    centroids[0] = x[rng.randint(len(x))]
+    distances = ((x - centroids[0])**2).sum(axis=1)
+    for i in range(1, k):
+        total = distances.sum()
+        centroids[i] = x[rng.choice(len(x), p=distances / total)
+                         if total > 0 else rng.randint(len(x))]
+        distances = np.minimum(distances, ((x - centroids[i])**2).sum(axis=1))
+
+    for _ in range(iterations):
+        labels, _ = nearest_centroids(x, centroids)
+        counts = np.bincount(labels, minlength=k)
+        sums = np.zeros_like(centroids)
+        np.add.at(sums, labels, x)
+        empty = counts == 0
+        centroids[~empty] = sums[~empty] / counts[~empty, None]
+        centroids[empty] = x[rng.choice(len(x), empty.sum())]
+    return centroids
+
+
+class FaceIndex:
+    """
+    Inverted-file (IVF) index over face embeddings, stored in a directory and memory-mapped.
+
+    Vectors are assigned to the nearest of nlist coarse centroids, and a search only scans the
+    nprobe lists closest to the query. Vectors are stored as float32, float16, or product
+    quantized (pq): the residual from the centroid is split into pq_m subvectors, each stored as
+    the index of the nearest of 256 codewords, so each vector takes pq_m bytes.
+
+    Vectors can be added incrementally. They are appended to files in the index directory, and
+    the inverted lists are rebuilt on the next search or call to flush.
+    """
+
+    def __init__(self, path):
+        self._path = path
+        with open(self._file('meta.json')) as f:
+            self._meta = json.load(f)
+        with open(self._file('videos.json')) as f:
+            self._videos = json.load(f)
+        self._centroids = self._load('centroids.npy')
+        self._codebooks = self._load('codebooks.npy')
+        self._lists = None
+
+    @classmethod
+    def create(cls, path, dim, nlist=1024, storage='float16', pq_m=16):
+        """
+        Creates an empty index. It must be trained before vectors are added.
+
+        Args:
+            path (str): Directory to store the index in.
+            dim (int): Dimension of the vectors.
+            nlist (int, optional): Number of inverted lists.
+            storage (str, optional): One of STORAGES.
+            pq_m (int, optional): Number of subvectors with pq storage. Must divide dim.
+        """
+        if storage not in STORAGES:
+            raise Exception('Invalid index storage "{}", must be one of {}'.format(
+                storage, STORAGES))
+        if storage == 'pq' and dim % pq_m != 0:
+            raise Exception('pq_m ({}) must divide the vector dimension ({})'.format(pq_m, dim))
+
+        os.makedirs(path, exist_ok=True)
+        meta = {'dim': dim, 'nlist': nlist, 'storage': storage, 'pq_m': pq_m, 'count': 0}
+        with open(os.path.join(path, 'meta.json'), 'w') as f:
+            json.dump(meta, f)
+        with open(os.path.join(path, 'videos.json'), 'w') as f:
+            json.dump([], f)
+        for name in ['vectors.bin', 'lists.bin', 'ids.bin']:
+            open(os.path.join(path, name), 'wb').close()
+        return cls(path)
+
+    def _file(self, name):
+        return os.path.join(self._path, name)
+
+    def _load(self, name):
+        return np.load(self._file(name)) if os.path.isfile(self._file(name)) else None
+
+    def _save_meta(self):
+        with open(self._file('meta.json'), 'w') as f:
+            json.dump(self._meta, f)
+        with open(self._file('videos.json'), 'w') as f:
+            json.dump(self._videos, f)
+
+    def __len__(self):
+        return self._meta['count']
+
+    def _vector_shape(self):
+        if self._meta['storage'] == 'pq':
+            return (self._meta['pq_m'], ), np.uint8
+        return (self._meta['dim'], ), np.dtype(self._meta['storage'])
+
+    def _memmap(self, name, dtype, shape=()):
+        if len(self) == 0:
+            return np.zeros((0, ) + shape, dtype=dtype)
+        return np.memmap(self._file(name), dtype=dtype, mode='r', shape=(len(self), ) + shape)
+
+    def train(self, sample, iterations=20):
+        """
+        Learns the coarse centroids (and pq codebooks) from a representative sample of vectors.
+        """
+        sample = np.asarray(sample, dtype=np.float32)
+        self._centroids = kmeans(sample, self._meta['nlist'], iterations=iterations)
+        np.save(self._file('centroids.npy'), self._centroids)
+
+        if self._meta['storage'] == 'pq':
+            labels, _ = nearest_centroids(sample, self._centroids)
+            residuals = sample - self._centroids[labels]
+            m = self._meta['pq_m']
+            self._codebooks = np.stack(
+                par_for(
+                    lambda sub: kmeans(sub, PQ_CENTROIDS, iterations=iterations),
+                    np.split(residuals, m, axis=1),
+                    progress=False))
+            np.save(self._file('codebooks.npy'), self._codebooks)
+
+    def _encode(self, vectors, lists):
+        if self._meta['storage'] != 'pq':
+            return vectors.astype(self._meta['storage'])
+        residuals = vectors - self._centroids[lists]
+        return np.stack(
+            [
+                nearest_centroids(sub, codebook)[0].astype(np.uint8)
+                for (sub, codebook) in zip(
+                    np.split(residuals, self._meta['pq_m'], axis=1), self._codebooks)
+            ],
+            axis=1)
+
+    def add(self, vectors, video, frames, bboxes):
+        """
+        Adds vectors to the index.
+
+        Args:
+            vectors (np.array): (N x dim) array of vectors.
+            video (str): Name of the video the faces come from.
+            frames (np.array): Frame number of each vector.
+            bboxes (np.array): Index of each vector's bbox within its frame.
+        """
+        if self._centroids is None:
+            raise Exception('Index must be trained before adding vectors')
+        vectors = np.asarray(vectors, dtype=np.float32).reshape((-1, self._meta['dim']))
+        if len(vectors) == 0:
+            return
+
+        if video not in self._videos:
+            self._videos.append(video)
+        ids = np.zeros(len(vectors), dtype=ID_DTYPE)
+        ids['video'] = self._videos.index(video)
+        ids['frame'] = frames
+        ids['bbox'] = bboxes
+
+        lists, _ = nearest_centroids(vectors, self._centroids)
+        for (name, data) in [('vectors.bin', self._encode(vectors, lists)),
+                             ('lists.bin', lists.astype('<i4')), ('ids.bin', ids)]:
+            with open(self._file(name), 'ab') as f:
+                f.write(np.ascontiguousarray(data).tobytes())
+
+        self._meta['count'] += len(vectors)
+        self._save_meta()
+        self._lists = None
+
+    def add_embeddings(self, video, embeddings, frames=None):
+        """
+        Adds the output of face_embedding.embed_faces for one video.
+
+        Args:
+            video (Video or str): The video, or its name.
+            embeddings (DataSource): Embeddings column of the video.
+            frames (list, optional): Frame number of each row of the column, if it was computed on
+                a subset of frames.
+        """
+        name = video.path() if hasattr(video, 'path') else video
+        rows = [e if e is not None else np.zeros((0, self._meta['dim'])) for e in embeddings.load()]
+        counts = [len(e) for e in rows]
+        row_frames = np.asarray(frames if frames is not None else np.arange(len(rows)))
+        self.add(
+            np.concatenate(rows) if len(rows) > 0 else np.zeros((0, self._meta['dim'])), name,
+            np.repeat(row_frames, counts), np.concatenate([np.arange(n) for n in counts] + [[]]))
+
+    def flush(self):
+        """
+        Rebuilds the inverted lists after vectors are added.
+        """
+        lists = self._memmap('lists.bin', '<i4')
+        order = np.argsort(lists, kind='mergesort')
+        counts = np.bincount(lists, minlength=self._meta['nlist'])
+        offsets = np.concatenate([[0], np.cumsum(counts)])
+        np.save(self._file('order.npy'), order)
+        np.save(self._file('offsets.npy'), offsets)
+        self._lists = None
+
+    def _inverted_lists(self):
+        if self._lists is None:
+            offsets = self._load('offsets.npy')
+            if offsets is None or offsets[-1] != len(self):
+                self.flush()
+                offsets = self._load('offsets.npy')
+            self._lists = (np.load(self._file('order.npy'), mmap_mode='r'), offsets)
+        return self._lists
+
+    def _list_distances(self, query, l, rows, vectors):
+        if self._meta['storage'] != 'pq':
+            return ((vectors[rows].astype(np.float32) - query)**2).sum(axis=1)
+
+        # Asymmetric distance: the query residual is compared exactly against each codeword
+        residual = np.split(query - self._centroids[l], self._meta['pq_m'])
+        table = np.stack([((codebook - r)**2).sum(axis=1)
+                          for (r, codebook) in zip(residual, self._codebooks)])
+        return table[np.arange(self._meta['pq_m']), vectors[rows]].sum(axis=1)
+
+    def search(self, queries, k=10, nprobe=8):
+        """
+        Finds the approximate k nearest faces of each query by L2 distance.
+
+        Args:
+            queries (np.array): (Q x dim) array of query vectors.
+            k (int, optional): Number of results per query.
+            nprobe (int, optional): Number of inverted lists to scan. Higher is more accurate and
+                slower.
+
+        Returns:
+            list: Per query, a list of up to k FaceMatch sorted by distance.
+        """
+        queries = np.asarray(queries, dtype=np.float32).reshape((-1, self._meta['dim']))
+        if len(self) == 0:
+            return [[] for _ in queries]
+
+        order, offsets = self._inverted_lists()
+        shape, dtype = self._vector_shape()
+        vectors = self._memmap('vectors.bin', dtype, shape)
+        ids = self._memmap('ids.bin', ID_DTYPE)
+
+        coarse = (self._centroids**2).sum(axis=1)[None, :] - 2 * queries.dot(self._centroids.T)
+        probes = np.argsort(coarse, axis=1)[:, :nprobe]
+
+        results = []
+        for (query, lists) in zip(queries, probes):
+            candidates = []
+            distances = []
+            for l in lists:
+                # Reading rows in file order keeps the memory-mapped reads sequential
+                rows = np.sort(order[offsets[l]:offsets[l + 1]])
+                candidates.append(rows)
+                distances.append(self._list_distances(query, l, rows, vectors))
+            candidates = np.concatenate(candidates)
+            distances = np.concatenate(distances)
+            top = np.argsort(distances, kind='mergesort')[:k]
+            results.append([
+                FaceMatch(
+                    video=self._videos[ids[i]['video']],
+                    frame=int(ids[i]['frame']),
+                    bbox=int(ids[i]['bbox']),
+                    distance=float(d)) for (i, d) in zip(candidates[top], distances[top])
+            ])
+        return results
+
+
+def build_index(path, videos, embeddings, frames=None, nlist=1024, storage='float16', pq_m=16,
+                train_size=100000):
+    """
+    Creates an index from the output of face_embedding.embed_faces.
+
+    The index is trained on up to train_size embeddings sampled from the first videos, then every
+    video's embeddings are added.
+
+    Args:
+        path (str): Directory to store the index in.
+        videos (list): Videos the embeddings were computed on.
+        embeddings (list): Embeddings column of each video.
+        frames (list, optional): Frame numbers of the rows of each column.
+
+    Returns:
+        FaceIndex: The index.
+    """
+    sample = []
+    for column in embeddings:
+        sample.extend([e for e in column.load() if e is not None and len(e) > 0])
+        if sum(len(e) for e in sample) >= train_size:
+            break
+    sample = np.concatenate(sample)[:train_size]
+
+    index = FaceIndex.create(
+        path, sample.shape[1], nlist=min(nlist, len(sample)), storage=storage, pq_m=pq_m)
+    index.train(sample)
+    for (i, (video, column)) in enumerate(zip(videos, embeddings)):
+        index.add_embeddings(video, column, frames[i] if frames is not None else None)
+    index.flush()
+    return index
@@ -1,44 +1,73 @@
-from .prelude import Pipeline, try_import
-from scannerpy.stdlib import readers
-from scannerpy.stdlib.util import download_temp_file
+from .prelude import Pipeline, try_import, register_codec, BBOX_CODEC
+from .resources import Resource
 from scannerpy import FrameType
+from typing import Sequence
 import scannerpy
-import cv2
-import pickle
+import numpy as np
 
 MODEL_FILE = 'https://storage.googleapis.com/esper/models/rude-carnie/21936.tar.gz'
 
-@scannerpy.register_python_op()
+DEFAULT_BATCH = 8
+
+# Labels produced by RudeCarnie, stored by their index in this list
+GENDER_LABELS = ['M', 'F']
+
+# One record per face, where label is an index into GENDER_LABELS
+GENDER_CODEC = register_codec('genders', [('label', 'u1'), ('confidence', '<f4')])
+
+
+@scannerpy.register_python_op(batch=DEFAULT_BATCH)
 class DetectGender(scannerpy.Kernel):
     def __init__(self, config):
         from carnie_helper import RudeCarnie
         self.config = config
         self.rc = RudeCarnie(model_dir=config.args['model_dir'])
 
-    def execute(self, frame: FrameType, bboxes: bytes) -> bytes:
-        frame = cv2.cvtColor(frame, cv2.COLOR_RGB2BGR)
-        [h, w] = frame.shape[:2]
-        bboxes = readers.bboxes(bboxes, self.config.protobufs)
-        frames = [frame[int(bbox.y1*h):int(bbox.y2*h), int(bbox.x1*w):int(bbox.x2*w)] for bbox in bboxes]
-        genders = self.rc.get_gender_batch(frames)
-        return pickle.dumps(genders)
+    def execute(self, frame: Sequence[FrameType], bboxes: Sequence[bytes]) -> Sequence[bytes]:
+        # Crop first and only convert the crops from RGB to BGR
+        counts = []
+        crops = []
+        for (img, frame_bboxes) in zip(frame, bboxes):
+            [h, w] = img.shape[:2]
+            frame_bboxes = BBOX_CODEC.decode(frame_bboxes, self.config.protobufs)
+            counts.append(len(frame_bboxes))
+            crops.extend([
+                np.ascontiguousarray(
+                    img[int(bbox.y1 * h):int(bbox.y2 * h), int(bbox.x1 * w):int(bbox.x2 * w), ::-1])
+                for bbox in frame_bboxes
+            ])
+
+        # Classify the faces from every frame in the batch at once
+        genders = self.rc.get_gender_batch(crops) if len(crops) > 0 else []
+
+        outputs = []
+        offset = 0
+        for n in counts:
+            outputs.append(
+                GENDER_CODEC.encode([(GENDER_LABELS.index(label), confidence)
+                                     for (label, confidence) in genders[offset:offset + n]]))
+            offset += n
+        return outputs
 
 
 class GenderDetectionPipeline(Pipeline):
     job_suffix = 'gender'
-    parser_fn = lambda _: lambda buf, _: pickle.loads(buf)
+    parser_fn = lambda _: GENDER_CODEC.decode
     additional_sources = ['bboxes']
     run_opts = {'pipeline_instances_per_node': 1}
+    resources = {'model': Resource(MODEL_FILE, untar=True)}
 
     def fetch_resources(self):
         try_import('carnie_helper', __name__)
-        self._model_dir = download_temp_file(MODEL_FILE, untar=True) + '/21936'
+        super().fetch_resources()
+        self._model_dir = self._resource_paths['model'] + '/21936'
 
-    def build_pipeline(self):
+    def build_pipeline(self, batch=DEFAULT_BATCH):
         return {'genders': self._db.ops.DetectGender(
             frame=self._sources['frame_sampled'].op,
             bboxes=self._sources['bboxes'].op,
-            model_dir=self._model_dir)}
+            model_dir=self._model_dir,
+            batch=batch)}
 
 
 detect_genders = GenderDetectionPipeline.make_runner()
@@ -18,6 +18,9 @@ from abc import ABC
 MASTER_POOL = 'default-pool'
 WORKER_POOL = 'workers'
 
+# Directory on each node where downloaded models are cached, shared by all pods on that node
+NODE_RESOURCE_DIR = '/var/lib/scannertools/resources'
+
 
 def run(s, detach=False):
     if detach:
@@ -266,6 +269,9 @@ class Cluster:
                 'name': 'scanner-config',
                 'mountPath': '/root/.scanner/config.toml',
                 'subPath': 'config.toml'
+            }, {
+                'name': 'resource-cache',
+                'mountPath': '/root/.scanner/resources'
             }],
             'env': [
                 {'name': 'GOOGLE_APPLICATION_CREDENTIALS',
@@ -340,6 +346,12 @@ class Cluster:
                         }, {
                             'name': 'scanner-config',
                             'configMap': {'name': 'scanner-config'}
+                        }, {
+                            'name': 'resource-cache',
+                            'hostPath': {
+                                'path': NODE_RESOURCE_DIR,
+                                'type': 'DirectoryOrCreate'
+                            }
                         }],
                         'nodeSelector': {
                             'cloud.google.com/gke-nodepool':
@@ -554,8 +566,11 @@ def master():
 
 
 def worker():
+    from .resources import prefetch
+
     print('Scannertools: fetching resources...')
     pipelines = cloudpickle.loads(base64.b64decode(os.environ['PIPELINES']))
+    prefetch(pipelines)
     for pipeline in pipelines:
         pipeline(None).fetch_resources()
 
@@ -1,11 +1,10 @@
 from .prelude import *
 from . import bboxes
-from scannerpy.stdlib.util import download_temp_file, temp_directory
-from scannerpy.stdlib import writers
+from .resources import Resource
 from scannerpy.stdlib.tensorflow import TensorFlowKernel
-from scannerpy import FrameType
+from scannerpy import FrameType, DeviceType
+from typing import Sequence
 import os
-import tarfile
 import numpy as np
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -16,43 +15,170 @@ DOWNLOAD_BASE = 'http://download.tensorflow.org/models/object_detection/'
 
 LABEL_URL = 'https://storage.googleapis.com/scanner-data/public/mscoco_label_map.pbtxt'
 
-GRAPH_PATH = os.path.join(
-    os.path.expanduser('~/.scanner/resources'), 'ssd_mobilenet_v1_coco_2017_11_17',
-    'frozen_inference_graph.pb')
+# Int8-quantized TFLite export of SSD-Mobilenet v1 trained on COCO, for backend='quantized'
+QUANTIZED_MODEL = Resource(
+    'https://storage.googleapis.com/download.tensorflow.org/models/tflite/'
+    'coco_ssd_mobilenet_v1_1.0_quant_2018_06_29.zip',
+    untar=True)
+QUANTIZED_MODEL_FILE = 'detect.tflite'
 
+BACKENDS = ['float', 'quantized']
 
-@scannerpy.register_python_op()
+DEFAULT_BATCH = 8
+
+
+def _encode_detections(boxes, scores, classes, min_score, labels):
+    # Drop low-scoring and unwanted detections before they're serialized and stored
+    keep = scores >= min_score
+    if labels is not None:
+        keep &= np.isin(classes, labels)
+
+    boxes = boxes[keep]
+    return BBOX_CODEC.encode_columns(
+        x1=boxes[:, 1],
+        y1=boxes[:, 0],
+        x2=boxes[:, 3],
+        y2=boxes[:, 2],
+        score=scores[keep],
+        label=classes[keep])
+
+
+@scannerpy.register_python_op(batch=DEFAULT_BATCH)
 class DetectObjects(TensorFlowKernel):
     def build_graph(self):
         import tensorflow as tf
         dnn = tf.Graph()
         with dnn.as_default():
             od_graph_def = tf.GraphDef()
-            with tf.gfile.GFile(GRAPH_PATH, 'rb') as fid:
+            with tf.gfile.GFile(self.config.args['graph_path'], 'rb') as fid:
                 serialized_graph = fid.read()
                 od_graph_def.ParseFromString(serialized_graph)
                 tf.import_graph_def(od_graph_def, name='')
+
+        # Look up the model's tensors once instead of on every call
+        self.image_tensor = dnn.get_tensor_by_name('image_tensor:0')
+        self.output_tensors = [
+            dnn.get_tensor_by_name('detection_boxes:0'),
+            dnn.get_tensor_by_name('detection_scores:0'),
+            dnn.get_tensor_by_name('detection_classes:0')
+        ]
+
+        self.min_score = self.config.args.get('min_score', 0.0)
+        labels = self.config.args.get('labels')
+        self.labels = np.array(labels) if labels is not None else None
+
         return dnn
 
-    # Evaluate object detection DNN model on a frame
+    # Evaluate object detection DNN model on a batch of frames
     # Return bounding box position, class and score
-    def execute(self, frame: FrameType) -> bytes:
-        image_tensor = self.graph.get_tensor_by_name('image_tensor:0')
-        boxes = self.graph.get_tensor_by_name('detection_boxes:0')
-        scores = self.graph.get_tensor_by_name('detection_scores:0')
-        classes = self.graph.get_tensor_by_name('detection_classes:0')
+    def execute(self, frame: Sequence[FrameType]) -> Sequence[bytes]:
         with self.graph.as_default():
             (boxes, scores, classes) = self.sess.run(
-                [boxes, scores, classes], feed_dict={image_tensor: np.expand_dims(frame, axis=0)})
+                self.output_tensors, feed_dict={self.image_tensor: np.stack(frame)})
+
+        return [
+            _encode_detections(boxes[i], scores[i], classes[i], self.min_score, self.labels)
+            for i in range(len(frame))
+        ]
+
+
+def _tflite_interpreter(model_path):
+    try:
+        from tflite_runtime.interpreter import Interpreter
+    except ImportError:
+        import tensorflow as tf
+        Interpreter = tf.lite.Interpreter if hasattr(tf, 'lite') else tf.contrib.lite.Interpreter
+    return Interpreter(model_path=model_path)
+
+
+@scannerpy.register_python_op(device_type=DeviceType.CPU, batch=DEFAULT_BATCH)
+class DetectObjectsQuantized(scannerpy.Kernel):
+    """
+    Runs the int8-quantized TFLite SSD-Mobilenet model on the CPU. Outputs the same boxes as
+    DetectObjects, except the model only returns its 10 highest-scoring detections per frame.
+    """
+
+    def __init__(self, config):
+        import cv2
+        self._cv2 = cv2
+        self.config = config
+        self.interpreter = _tflite_interpreter(config.args['model_path'])
+        self.interpreter.allocate_tensors()
 
-            bboxes = [
-                self.protobufs.BoundingBox(
-                    x1=box[1], y1=box[0], x2=box[3], y2=box[2], score=score, label=cls)
-                for (box, score, cls) in zip(
-                    boxes.reshape(100, 4), scores.reshape(100, 1), classes.reshape(100, 1))
+        [input_details] = self.interpreter.get_input_details()
+        self.input_index = input_details['index']
+        self.input_size = tuple(input_details['shape'][1:3])
+        # Outputs are boxes, classes, scores and the number of detections
+        self.output_indices = [d['index'] for d in self.interpreter.get_output_details()[:3]]
+
+        self.min_score = config.args.get('min_score', 0.0)
+        labels = config.args.get('labels')
+        self.labels = np.array(labels) if labels is not None else None
+
+    def execute(self, frame: Sequence[FrameType]) -> Sequence[bytes]:
+        outputs = []
+        for img in frame:
+            # The model takes a single uint8 image at a fixed size
+            resized = self._cv2.resize(img, (self.input_size[1], self.input_size[0]))
+            self.interpreter.set_tensor(self.input_index, resized[np.newaxis])
+            self.interpreter.invoke()
+            (boxes, classes, scores) = [
+                self.interpreter.get_tensor(i)[0] for i in self.output_indices
             ]
 
-            return writers.bboxes(bboxes, self.protobufs)
+            # Classes are 0-based, while the float model uses 1-based COCO label ids
+            outputs.append(
+                _encode_detections(
+                    np.clip(boxes, 0, 1), scores, classes + 1, self.min_score, self.labels))
+        return outputs
+
+
+def compare_detections(reference, candidate, iou_threshold=0.5, min_score=0.5):
+    """
+    Measures how closely one model's detections match another's, e.g. the quantized backend
+    against the float model. Boxes scoring at least min_score are matched greedily by IoU between
+    boxes of the same label, from the highest-scoring reference box down.
+
+    Args:
+        reference (list): Per frame, reference bboxes (e.g. from the float model).
+        candidate (list): Per frame, bboxes to compare.
+
+    Returns:
+        dict: precision and recall of the candidate boxes, the mean IoU and mean absolute score
+            difference of matched boxes, and the number of reference and candidate boxes.
+    """
+    matches = []
+    num_reference = 0
+    num_candidate = 0
+    for (ref, cand) in zip(reference, candidate):
+        ref = bboxes.bboxes_to_np(ref)
+        cand = bboxes.bboxes_to_np(cand)
+        ref = ref[ref[:, 4] >= min_score]
+        cand = cand[cand[:, 4] >= min_score]
+        num_reference += len(ref)
+        num_candidate += len(cand)
+        if len(ref) == 0 or len(cand) == 0:
+            continue
+
+        ious = bboxes.iou_matrix(ref, cand)
+        ious[ref[:, None, 5] != cand[None, :, 5]] = 0
+        used = np.zeros(len(cand), dtype=np.bool_)
+        for i in np.argsort(-ref[:, 4]):
+            ious[i, used] = 0
+            j = np.argmax(ious[i])
+            if ious[i, j] >= iou_threshold:
+                used[j] = True
+                matches.append((ious[i, j], abs(ref[i, 4] - cand[j, 4])))
+
+    matches = np.array(matches).reshape((-1, 2))
+    return {
+        'precision': len(matches) / num_candidate if num_candidate > 0 else 1.0,
+        'recall': len(matches) / num_reference if num_reference > 0 else 1.0,
+        'mean_iou': matches[:, 0].mean() if len(matches) > 0 else 0.0,
+        'mean_score_diff': matches[:, 1].mean() if len(matches) > 0 else 0.0,
+        'num_reference': num_reference,
+        'num_candidate': num_candidate
+    }
 
 
 class ObjectDetectionPipeline(Pipeline):
@@ -60,31 +186,87 @@ class ObjectDetectionPipeline(Pipeline):
     Detects objects in a video.
 
     Uses the SSD-Mobilenet architecture from the TensorFlow `Object Detection API <https://github.com/tensorflow/models/tree/abd504235f3c2eed891571d62f0a424e54a2dabc/research/object_detection>`_.
+
+    With backend='quantized', detection runs on the CPU with an int8-quantized TFLite export of
+    the model, which is faster on CPU-only workers at some cost in accuracy. Use
+    compare_detections to measure the difference on your videos.
     """
 
     job_suffix = 'objdet'
-    parser_fn = lambda _: readers.bboxes
+    parser_fn = lambda _: BBOX_CODEC.decode
     run_opts = {'pipeline_instances_per_node': 1}
+    resources = {
+        'model': Resource(DOWNLOAD_BASE + MODEL_FILE, untar=True),
+        'labels': Resource(LABEL_URL),
+        'quantized_model': QUANTIZED_MODEL
+    }
+    _backend = 'float'
+
+    # Resources needed by each backend
+    backend_resources = {'float': ['model', 'labels'], 'quantized': ['quantized_model']}
+
+    def execute(self, pipeline_args={}, **kwargs):
+        # Resources are fetched before build_pipeline runs, so pick the backend up front
+        self._backend = pipeline_args.get('backend', 'float')
+        if self._backend not in BACKENDS:
+            raise Exception('Invalid object detection backend "{}", must be one of {}'.format(
+                self._backend, BACKENDS))
+        return super().execute(pipeline_args=pipeline_args, **kwargs)
 
     def fetch_resources(self):
-        try_import('tensorflow', __name__)
+        from .resources import fetch_all
 
-        if not os.path.isdir(os.path.join(temp_directory(), MODEL_NAME)):
-            log.debug('Downloading model')
-            model_tar_path = download_temp_file(DOWNLOAD_BASE + MODEL_FILE)
-            with tarfile.open(model_tar_path) as f:
-                f.extractall(temp_directory())
-            download_temp_file(LABEL_URL)
+        if self._backend == 'quantized':
+            try:
+                try_import('tflite_runtime.interpreter', __name__)
+            except Exception:
+                try_import('tensorflow', __name__)
+        else:
+            try_import('tensorflow', __name__)
 
-    def build_pipeline(self):
-        bboxes = self._db.ops.DetectObjects(frame=self._sources[
-            'frame_sampled'].op if 'frame_sampled' in self._sources else self._sources['frame'].op)
-        outputs = {'bboxes': bboxes}
+        self._resource_paths = fetch_all(
+            {name: self.resources[name]
+             for name in self.backend_resources[self._backend]})
+        if self._backend == 'quantized':
+            self._model_path = os.path.join(self._resource_paths['quantized_model'],
+                                            QUANTIZED_MODEL_FILE)
+        else:
+            self._graph_path = os.path.join(self._resource_paths['model'], MODEL_NAME,
+                                            'frozen_inference_graph.pb')
 
-        # if nms_threshold is not None:
-        #     outputs['nmsed_bboxes'] = self._db.ops.BboxNMS(bboxes, threshold=nms_threshold)
+    def build_pipeline(self,
+                       min_score=0.0,
+                       labels=None,
+                       nms_threshold=None,
+                       soft_nms=False,
+                       batch=DEFAULT_BATCH,
+                       backend='float'):
+        frame = self._sources['frame_sampled'].op \
+            if 'frame_sampled' in self._sources else self._sources['frame'].op
+        if backend == 'float':
+            bboxes = self._db.ops.DetectObjects(
+                frame=frame,
+                graph_path=self._graph_path,
+                min_score=min_score,
+                labels=labels,
+                batch=batch)
+        elif backend == 'quantized':
+            try_import('cv2', __name__)
+            bboxes = self._db.ops.DetectObjectsQuantized(
+                frame=frame,
+                model_path=self._model_path,
+                min_score=min_score,
+                labels=labels,
+                batch=batch)
+        else:
+            raise Exception('Invalid object detection backend "{}", must be one of {}'.format(
+                backend, BACKENDS))
 
-        return outputs
+        # Suppress overlapping boxes on the workers so only the survivors are stored
+        if nms_threshold is not None:
+            bboxes = self._db.ops.BboxNMS(bboxes, threshold=nms_threshold, soft=soft_nms)
+
+        return {'bboxes': bboxes}
 
 
 detect_objects = ObjectDetectionPipeline.make_runner()
@@ -1,28 +1,267 @@
 from .prelude import *
+from typing import Sequence
 import os
 import pickle
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
+# Storage precisions for compact flow fields
+FLOW_PRECISIONS = ['float32', 'float16', 'int8']
+
+# Header of a compact flow field: the stored field's shape, its precision as an index into
+# FLOW_PRECISIONS, the int8 quantization step, and the downsampling factor
+FLOW_HEADER = np.dtype([('height', '<u4'), ('width', '<u4'), ('precision', 'u1'),
+                        ('scale', '<f4'), ('downsample', '<u4')])
+
+# Quality presets of the CPU flow kernel: the OpenCV DIS preset, and the scale at which frames
+# are downsampled before computing flow
+FLOW_PRESETS = {
+    'ultrafast': {'dis_preset': 'ULTRAFAST', 'scale': 0.25},
+    'fast': {'dis_preset': 'FAST', 'scale': 0.5},
+    'medium': {'dis_preset': 'MEDIUM', 'scale': 0.5},
+}
+
+# Number of direction bins in the per-frame motion histogram
+DIRECTION_BINS = 8
+
+# Per-frame motion summary. Magnitudes are in pixels, direction is the angle in radians of the
+# mean flow vector, and histogram is the fraction of total motion in each direction bin.
+FLOW_SUMMARY_CODEC = register_codec(
+    'flow_summary', [('mean_magnitude', '<f4'), ('median_magnitude', '<f4'),
+                     ('p95_magnitude', '<f4'), ('direction', '<f4'),
+                     ('histogram', '<f4', (DIRECTION_BINS, ))])
+
+
+def downsample_flow(flow, factor):
+    """
+    Averages flow vectors over factor x factor blocks. Vectors stay in full-resolution pixels.
+    """
+    if factor == 1:
+        return flow
+    h, w = (flow.shape[0] // factor) * factor, (flow.shape[1] // factor) * factor
+    return flow[:h, :w].reshape((h // factor, factor, w // factor, factor, 2)).mean(axis=(1, 3))
+
+
+def encode_flow(flow, precision='float32', downsample=1):
+    """
+    Serializes a flow field, optionally downsampled and at reduced precision.
+
+    Args:
+        flow (np.array): (H x W x 2) flow field.
+        precision (str, optional): One of FLOW_PRECISIONS. int8 quantizes each frame linearly
+            between -max and +max of its absolute flow values.
+        downsample (int, optional): Factor by which to shrink the field in each dimension.
+
+    Returns:
+        bytes: Encoded field.
+    """
+    flow = downsample_flow(flow.astype(np.float32), downsample)
+    scale = 1.0
+    if precision == 'int8':
+        scale = max(float(np.abs(flow).max()) / 127, 1e-6)
+        data = np.round(flow / scale).astype(np.int8)
+    else:
+        data = flow.astype(precision)
+    header = np.array(
+        (flow.shape[0], flow.shape[1], FLOW_PRECISIONS.index(precision), scale, downsample),
+        dtype=FLOW_HEADER)
+    return header.tobytes() + data.tobytes()
+
+
+def decode_flow(buf, _proto=None):
+    """
+    Decodes a field from encode_flow into a float32 (H/downsample x W/downsample x 2) array.
+    """
+    header = np.frombuffer(buf, dtype=FLOW_HEADER, count=1)[0]
+    data = np.frombuffer(
+        buf, dtype=FLOW_PRECISIONS[header['precision']], offset=FLOW_HEADER.itemsize)
+    flow = data.reshape((header['height'], header['width'], 2)).astype(np.float32)
+    if header['precision'] == FLOW_PRECISIONS.index('int8'):
+        flow *= header['scale']
+    return flow
+
+
+def summarize_flow(flow):
+    """
+    Computes the motion summary record of a flow field, see FLOW_SUMMARY_CODEC.
+    """
+    dx = flow[..., 0].ravel()
+    dy = flow[..., 1].ravel()
+    magnitude = np.sqrt(dx**2 + dy**2)
+    angle = np.arctan2(dy, dx)
+    bins = np.minimum(
+        ((angle + np.pi) / (2 * np.pi) * DIRECTION_BINS).astype(np.int64), DIRECTION_BINS - 1)
+    histogram = np.bincount(bins, weights=magnitude, minlength=DIRECTION_BINS)
+    total = histogram.sum()
+    median, p95 = np.percentile(magnitude, [50, 95])
+    return (magnitude.mean(), median, p95, np.arctan2(dy.mean(), dx.mean()),
+            histogram / total if total > 0 else histogram)
+
+
+@scannerpy.register_python_op(name='DISOpticalFlow', stencil=[-1, 0])
+class DISOpticalFlow(scannerpy.Kernel):
+    """
+    Computes dense flow on the CPU with OpenCV's DIS algorithm on downscaled grayscale frames.
+    Vectors are rescaled to full-resolution pixels, and the field is upsampled to full resolution
+    unless upsample is False.
+    """
+
+    def __init__(self, config):
+        import cv2
+        self._cv2 = cv2
+        preset = FLOW_PRESETS[config.args['preset']]
+        self._scale = config.args.get('scale') or preset['scale']
+        self._upsample = config.args.get('upsample', True)
+        self._dis = cv2.DISOpticalFlow_create(
+            getattr(cv2, 'DISOPTICAL_FLOW_PRESET_' + preset['dis_preset']))
+        self._config = config
+
+    def _prepare(self, frame):
+        cv2 = self._cv2
+        gray = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        if self._scale == 1:
+            return gray
+        return cv2.resize(
+            gray, None, fx=self._scale, fy=self._scale, interpolation=cv2.INTER_AREA)
+
+    def execute(self, frame: Sequence[FrameType]) -> FrameType:
+        cv2 = self._cv2
+        [prev, cur] = frame
+        flow = self._dis.calc(self._prepare(prev), self._prepare(cur), None)
+        if self._upsample and self._scale != 1:
+            flow = cv2.resize(
+                flow, (cur.shape[1], cur.shape[0]), interpolation=cv2.INTER_LINEAR)
+        return flow / self._scale if self._scale != 1 else flow
+
+
+@scannerpy.register_python_op(name='CompressFlow')
+def compress_flow(config, flow: FrameType) -> bytes:
+    return encode_flow(
+        flow, precision=config.args['precision'], downsample=config.args['downsample'])
+
+
+@scannerpy.register_python_op(name='SummarizeFlow')
+def summarize_flow_op(config, flow: FrameType) -> bytes:
+    return FLOW_SUMMARY_CODEC.encode([summarize_flow(flow)])
+
 
 class OpticalFlowPipeline(Pipeline):
     """
     Computes optical flow on a video.
 
-    Unlike other functions, flow fields aren't materialized into memory as they're simply
-    too large.
+    Unlike other functions, full-precision flow fields aren't materialized into memory as they're
+    simply too large. Pass precision and/or downsample to store a compact field that loads as
+    float32 arrays, and summary=True to also store a per-frame motion summary. With dense=False,
+    only the summary is stored.
+
+    If both a field and a summary are stored, each video's output is a (flow, summary) pair.
+
+    By default flow is computed by Scanner's OpticalFlow op. With algorithm='dis', it is
+    computed on the CPU by DISOpticalFlow at one of the FLOW_PRESETS, each sampled frame against
+    the frame just before it. pair_stride=N then computes flow for every Nth frame only.
     """
 
     job_suffix = 'flow'
     parser_fn = lambda _: None
 
-    def build_pipeline(self):
-        return {
-            'flow':
-            self._db.ops.OpticalFlow(
+    def build_sources(self,
+                      videos=None,
+                      frames=None,
+                      pair_stride=1,
+                      gate=None,
+                      gate_min_score=0.0,
+                      gate_labels=None,
+                      **kwargs):
+        if pair_stride > 1 and (frames is not None or gate is not None):
+            raise Exception('pair_stride cannot be combined with frames or gate')
+        self._pair_stride = pair_stride
+        sources = super().build_sources(
+            videos=videos,
+            frames=frames,
+            gate=gate,
+            gate_min_score=gate_min_score,
+            gate_labels=gate_labels,
+            **kwargs)
+
+        # A gate replaces the sampled frames with the frames that passed it
+        self._frames = sources['frame_sampled'].args if gate is not None else frames
+        return sources
+
+    def _dis_flow(self, preset, scale, upsample):
+        try_import('cv2', __name__)
+        if preset not in FLOW_PRESETS:
+            raise Exception('Invalid flow preset "{}", must be one of {}'.format(
+                preset, list(FLOW_PRESETS.keys())))
+
+        # Flow is computed on the full frame stream so each sampled frame is paired with its
+        # predecessor, then sampled the same way the frames would have been. Scanner only
+        # decodes and computes the rows needed by the sampled output.
+        flow = self._db.ops.DISOpticalFlow(
+            frame=self._sources['frame'].op, preset=preset, scale=scale, upsample=upsample)
+        sampled = self._sources['frame_sampled']
+        if self._frames is None:
+            self._sources['frame_sampled'] = BoundOp(
+                op=self._db.streams.Stride(flow),
+                args=[self._pair_stride for _ in range(len(sampled.args))])
+        elif isinstance(self._frames, list):
+            self._sources['frame_sampled'] = BoundOp(
+                op=self._db.streams.Gather(flow), args=sampled.args)
+        else:
+            self._sources['frame_sampled'] = BoundOp(op=self._frames(flow), args=None)
+        return self._sources['frame_sampled'].op
+
+    def build_pipeline(self,
+                       precision='float32',
+                       downsample=1,
+                       summary=False,
+                       dense=True,
+                       algorithm=None,
+                       preset='fast',
+                       scale=None,
+                       upsample=True):
+        if precision not in FLOW_PRECISIONS:
+            raise Exception('Invalid flow precision "{}", must be one of {}'.format(
+                precision, FLOW_PRECISIONS))
+        if not dense and not summary:
+            raise Exception('At least one of dense or summary must be set')
+
+        if algorithm == 'dis':
+            flow = self._dis_flow(preset, scale, upsample)
+        elif algorithm is None:
+            if self._pair_stride > 1:
+                raise Exception('pair_stride requires algorithm=\'dis\'')
+            flow = self._db.ops.OpticalFlow(
                 frame=self._sources['frame_sampled'].op,
                 device=DeviceType.GPU if self._db.has_gpu() else DeviceType.CPU)
-        }
+        else:
+            raise Exception('Invalid flow algorithm "{}"'.format(algorithm))
+
+        self._parsers = {}
+        outputs = {}
+        if dense:
+            if precision == 'float32' and downsample == 1:
+                outputs['flow'] = flow
+                self._parsers['flow'] = None
+            else:
+                outputs['flow'] = self._db.ops.CompressFlow(
+                    flow=flow, precision=precision, downsample=downsample)
+                self._parsers['flow'] = decode_flow
+        if summary:
+            outputs['flow_summary'] = self._db.ops.SummarizeFlow(flow=flow)
+            self._parsers['flow_summary'] = FLOW_SUMMARY_CODEC.decode
+        return outputs
+
+    def parse_output(self):
+        columns = [{
+            name: ScannerColumn(self._db.table(t).column(name), parser)
+            for (name, parser) in self._parsers.items()
+        } if self._db.table(t).committed() else None for t in self._sink.args]
+
+        names = [name for name in ['flow', 'flow_summary'] if name in self._parsers]
+        return [
+            (tuple(c[name] for name in names) if len(names) > 1 else c[names[0]])
+            if c is not None else None for c in columns
+        ]
 
 
 compute_flow = OpticalFlowPipeline.make_runner()
@@ -1,49 +1,50 @@
 from .prelude import *
-from scannerpy.stdlib.util import temp_directory, download_temp_file
+from .resources import Resource, cache_dir
 
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 
+POSE_FS_URL = 'http://posefs1.perception.cs.cmu.edu/OpenPose/models/'
+OPENPOSE_URL = 'https://raw.githubusercontent.com/CMU-Perceptual-Computing-Lab/openpose/master/models/'
+
 
 class PoseDetectionPipeline(Pipeline):
     job_suffix = 'pose'
     parser_fn = lambda _: readers.poses
     run_opts = {'work_packet_size': 8}
-
-    def fetch_resources(self):
-        self._models_path = os.path.join(temp_directory(), 'openpose')
-        pose_fs_url = 'http://posefs1.perception.cs.cmu.edu/OpenPose/models/'
+    resources = {
         # Pose prototxt
-        download_temp_file(
-            'https://raw.githubusercontent.com/CMU-Perceptual-Computing-Lab/'
-            'openpose/master/models/pose/coco/pose_deploy_linevec.prototxt',
-            'openpose/pose/coco/pose_deploy_linevec.prototxt')
+        'pose_prototxt': Resource(
+            OPENPOSE_URL + 'pose/coco/pose_deploy_linevec.prototxt',
+            path='openpose/pose/coco/pose_deploy_linevec.prototxt'),
         # Pose model weights
-        download_temp_file(
-            os.path.join(pose_fs_url, 'pose/coco/pose_iter_440000.caffemodel'),
-            'openpose/pose/coco/pose_iter_440000.caffemodel')
+        'pose_model': Resource(
+            POSE_FS_URL + 'pose/coco/pose_iter_440000.caffemodel',
+            path='openpose/pose/coco/pose_iter_440000.caffemodel'),
         # Hands prototxt
-        download_temp_file(
-            'https://raw.githubusercontent.com/CMU-Perceptual-Computing-Lab/'
-            'openpose/master/models/hand/pose_deploy.prototxt',
-            'openpose/hand/pose_deploy.prototxt')
+        'hand_prototxt': Resource(
+            OPENPOSE_URL + 'hand/pose_deploy.prototxt',
+            path='openpose/hand/pose_deploy.prototxt'),
         # Hands model weights
-        download_temp_file(
-            os.path.join(pose_fs_url, 'hand/pose_iter_102000.caffemodel'),
-            'openpose/hand/pose_iter_102000.caffemodel')
+        'hand_model': Resource(
+            POSE_FS_URL + 'hand/pose_iter_102000.caffemodel',
+            path='openpose/hand/pose_iter_102000.caffemodel'),
         # Face prototxt
-        download_temp_file(
-            'https://raw.githubusercontent.com/CMU-Perceptual-Computing-Lab/'
-            'openpose/master/models/face/pose_deploy.prototxt',
-            'openpose/face/pose_deploy.prototxt')
+        'face_prototxt': Resource(
+            OPENPOSE_URL + 'face/pose_deploy.prototxt',
+            path='openpose/face/pose_deploy.prototxt'),
         # Face model weights
-        download_temp_file(
-            os.path.join(pose_fs_url, 'face/pose_iter_116000.caffemodel'),
-            'openpose/face/pose_iter_116000.caffemodel')
+        'face_model': Resource(
+            POSE_FS_URL + 'face/pose_iter_116000.caffemodel',
+            path='openpose/face/pose_iter_116000.caffemodel'),
         # Face haar cascades
-        download_temp_file(
-            'https://raw.githubusercontent.com/CMU-Perceptual-Computing-Lab/'
-            'openpose/master/models/face/haarcascade_frontalface_alt.xml',
-            'openpose/face/haarcascade_frontalface_alt.xml')
+        'face_cascade': Resource(
+            OPENPOSE_URL + 'face/haarcascade_frontalface_alt.xml',
+            path='openpose/face/haarcascade_frontalface_alt.xml'),
+    }  # yapf: disable
+
+    def fetch_resources(self):
+        super().fetch_resources()
+        self._models_path = os.path.join(cache_dir(), 'openpose')
 
     def build_pipeline(self):
         pose_args = self._db.protobufs.OpenPoseArgs()
@@ -19,6 +19,9 @@ from functools import wraps
 from abc import ABC
 import inspect
 from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+from collections import deque
+from itertools import islice
+import traceback
 from tqdm import tqdm
 import multiprocessing as mp
 
@@ -138,6 +141,41 @@ def sample_video(delete=True):
         yield Video(f.name)
 
 
+@contextmanager
+def synthetic_video(width=640, height=360, num_frames=300, fps=30, gop=30, delete=True):
+    """
+    Generates an H.264 test pattern video locally with ffmpeg's `testsrc` source.
+
+    Unlike sample_video, this needs no network access, and the resolution, length and GOP size
+    (distance between keyframes) can be controlled to exercise different decode paths.
+    """
+    from .video import Video
+
+    if delete:
+        path = tempfile.NamedTemporaryFile(suffix='.mp4', delete=False).name
+    else:
+        path = '/tmp/synthetic_{}x{}_{}f_{}fps_g{}.mp4'.format(width, height, num_frames, fps,
+                                                             gop)
+        if os.path.isfile(path):
+            yield Video(path)
+            return
+
+    fnull = open(os.devnull, 'w')
+    sp.check_call(
+        'ffmpeg -y -f lavfi -i testsrc=size={}x{}:rate={} -frames:v {} -c:v libx264 '
+        '-pix_fmt yuv420p -g {gop} -keyint_min {gop} -sc_threshold 0 "{}"'.format(
+            width, height, fps, num_frames, path, gop=gop),
+        shell=True,
+        stdout=fnull,
+        stderr=fnull)
+
+    try:
+        yield Video(path)
+    finally:
+        if delete:
+            os.remove(path)
+
+
 def tile(imgs, rows=None, cols=None):
     # If neither rows/cols is specified, make a square
     if rows is None and cols is None:
@@ -182,6 +220,147 @@ class BoundOp:
     args = attrib()
 
 
+class Codec:
+    """
+    Fixed-width binary format for a column of kernel outputs.
+
+    A row is a little-endian uint32 record count followed by that many packed records of `dtype`,
+    so it can be decoded with a single np.frombuffer, or read without Python at all. Frames with no
+    records still produce a non-empty row. If counted is False, a row is one array of `dtype`
+    reshaped to `shape`, with no count.
+
+    Counted codecs can take a `legacy` function to decode rows written in an older format. A row
+    whose length doesn't match its count is passed to legacy(buf, protobufs), which returns its
+    records as a list of tuples.
+    """
+
+    COUNT_DTYPE = np.dtype('<u4')
+
+    def __init__(self, name, dtype, counted=True, shape=None, legacy=None):
+        self.name = name
+        self.dtype = np.dtype(dtype)
+        self.counted = counted
+        self.shape = shape
+        self.legacy = legacy
+
+    def encode(self, records):
+        """
+        Args:
+            records: Structured array, list of tuples, or ndarray matching the codec dtype.
+
+        Returns:
+            bytes: Encoded row.
+        """
+        if self.dtype.subdtype is not None:
+            # Converting directly to a subarray dtype would broadcast each element into a subarray
+            records = np.asarray(records, dtype=self.dtype.base).reshape((-1, ) + self.dtype.shape)
+        else:
+            records = np.asarray(records, dtype=self.dtype)
+        if not self.counted:
+            return records.tobytes()
+        return np.array(len(records), dtype=self.COUNT_DTYPE).tobytes() + records.tobytes()
+
+    def encode_columns(self, **columns):
+        """
+        Encodes a row from one array per field of a structured dtype.
+        """
+        n = len(next(iter(columns.values())))
+        records = np.zeros(n, dtype=self.dtype)
+        for k, v in columns.items():
+            records[k] = v
+        return self.encode(records)
+
+    def _view(self, records):
+        # Records of structured dtypes support attribute access, e.g. bbox.x1
+        return records.view(np.recarray) if self.dtype.names is not None else records
+
+    def _is_legacy(self, buf):
+        if self.legacy is None:
+            return False
+        size = self.COUNT_DTYPE.itemsize
+        if len(buf) < size:
+            return True
+        count = int(np.frombuffer(buf, dtype=self.COUNT_DTYPE, count=1)[0])
+        return len(buf) != size + count * self.dtype.itemsize
+
+    def _upgrade(self, buf, protobufs):
+        return self.encode(self.legacy(buf, protobufs)) if self._is_legacy(buf) else buf
+
+    def decode(self, buf, protobufs=None):
+        """
+        Decodes a row. Has the signature of a Scanner column parser, so it can be a parser_fn.
+
+        Args:
+            buf (bytes): Encoded row.
+            protobufs: Scanner protobufs, only needed to decode legacy rows.
+        """
+        if not self.counted:
+            records = np.frombuffer(buf, dtype=self.dtype)
+            return records.reshape(self.shape) if self.shape is not None else records
+
+        buf = self._upgrade(buf, protobufs)
+        count = int(np.frombuffer(buf, dtype=self.COUNT_DTYPE, count=1)[0])
+        return self._view(
+            np.frombuffer(buf, dtype=self.dtype, count=count, offset=self.COUNT_DTYPE.itemsize))
+
+    def decode_many(self, bufs, protobufs=None):
+        """
+        Decodes many rows at once into a single array.
+
+        Args:
+            bufs (List[bytes]): Encoded rows.
+            protobufs: Scanner protobufs, only needed to decode legacy rows.
+
+        Returns:
+            (np.array, np.array): All records, and offsets such that the records of row i are
+            records[offsets[i]:offsets[i+1]].
+        """
+        if not self.counted:
+            records = np.frombuffer(b''.join(bufs), dtype=self.dtype)
+            shape = self.shape if self.shape is not None else (-1, )
+            return records.reshape((len(bufs), ) + shape), np.arange(len(bufs) + 1)
+
+        size = self.COUNT_DTYPE.itemsize
+        bufs = [self._upgrade(buf, protobufs) for buf in bufs]
+        counts = [int(np.frombuffer(buf, dtype=self.COUNT_DTYPE, count=1)[0]) for buf in bufs]
+        records = np.frombuffer(
+            b''.join([memoryview(buf)[size:] for buf in bufs]), dtype=self.dtype)
+        offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int64)
+        return self._view(records), offsets
+
+
+CODECS = {}
+
+
+def register_codec(name, dtype, counted=True, shape=None, legacy=None):
+    """
+    Creates a Codec and registers it by name, so the format of each output type can be looked up.
+    """
+    codec = Codec(name, dtype, counted=counted, shape=shape, legacy=legacy)
+    CODECS[name] = codec
+    return codec
+
+
+def get_codec(name):
+    return CODECS[name]
+
+
+def _legacy_bboxes(buf, protobufs):
+    # Bboxes used to be stored as Scanner's length-prefixed BoundingBox protobufs
+    if protobufs is None:
+        raise Exception('Decoding bboxes stored in the legacy protobuf format requires protobufs')
+    return [(b.x1, b.y1, b.x2, b.y2, b.score, b.label) for b in readers.bboxes(buf, protobufs)]
+
+
+BBOX_CODEC = register_codec(
+    'bboxes', [('x1', '<f4'), ('y1', '<f4'), ('x2', '<f4'), ('y2', '<f4'), ('score', '<f4'),
+               ('label', '<i4')],
+    legacy=_legacy_bboxes)
+
+# Output of Scanner's built-in Histogram op: 16 int32 bins for each of 3 channels
+HISTOGRAM_CODEC = register_codec('histogram', '<i4', counted=False, shape=(3, -1))
+
+
 class DataSource(ABC):
     def load(self):
         raise NotImplemented
@@ -211,6 +390,52 @@ class ScannerColumn(DataSource):
         return self._column
 
 
+def gate_rows(column, min_score=0.0, labels=None):
+    """
+    Finds the rows of a bbox column with at least one box scoring at least min_score, and with a
+    label in labels if given.
+
+    Returns:
+        (list, int): Indices of the qualifying rows, and the number of rows in the column.
+    """
+    qualifies = [
+        bboxes is not None and len(bboxes) > 0 and bool(
+            np.any((bboxes.score >= min_score) &
+                   (np.isin(bboxes.label, labels) if labels is not None else True)))
+        for bboxes in column.load()
+    ]
+    return [i for (i, q) in enumerate(qualifies) if q], len(qualifies)
+
+
+class GatedColumn(DataSource):
+    """
+    Output of a pipeline run with a gate, scattered back to one row per row of the gate. Rows
+    of frames that were gated out load as None.
+    """
+
+    def __init__(self, column, rows, num_rows):
+        self._column = column
+        self._rows = rows
+        self._num_rows = num_rows
+
+    def load(self):
+        values = self._column.load() if self._column is not None else iter([])
+        rows = iter(self._rows)
+        next_row = next(rows, None)
+        for i in range(self._num_rows):
+            if i == next_row:
+                yield next(values)
+                next_row = next(rows, None)
+            else:
+                yield None
+
+    def scanner_source(self, db):
+        raise Exception('Gated outputs cannot be used as Scanner sources')
+
+    def scanner_args(self, db):
+        raise Exception('Gated outputs cannot be used as Scanner sources')
+
+
 class Pipeline(ABC):
     job_suffix = None
     parser_fn = None
@@ -218,6 +443,12 @@ class Pipeline(ABC):
     additional_sources = []
     run_opts = {}
 
+    # Manifest of files to download before running, as a dict of name -> Resource
+    resources = {}
+
+    # Per video, the gate rows that passed and the total number of gate rows, if run with a gate
+    _gate = None
+
     def __init__(self, db):
         self._db = db
 
@@ -244,13 +475,77 @@ class Pipeline(ABC):
         return jobs
 
     def fetch_resources(self):
-        pass
-
-    def build_sources(self, videos=None, frames=None, **kwargs):
+        from .resources import fetch_all
+        self._resource_paths = fetch_all(self.resources)
+
+    def _apply_gate(self, videos, frames, sources, gate, min_score, labels):
+        if gate is True:
+            if 'bboxes' not in sources:
+                raise Exception('gate=True requires a bboxes source')
+            gate = sources['bboxes']
+        if frames is not None and not isinstance(frames, list):
+            raise Exception('A gate can only be combined with frames given as a list')
+
+        # Find the rows of each video with at least one qualifying box
+        (all_rows, num_rows) = zip(*[gate_rows(column, min_score, labels) for column in gate]) \
+            if len(gate) > 0 else ([], [])
+        self._gate = (list(all_rows), list(num_rows))
+
+        # Videos with no qualifying rows are not run at all
+        keep = [i for i in range(len(videos)) if len(all_rows[i]) > 0]
+        self._gate_rows = [all_rows[i] for i in keep]
+        return ([videos[i] for i in keep],
+                [[frames[i][r] if frames is not None else r for r in all_rows[i]] for i in keep],
+                {k: [v[i] for i in keep] for (k, v) in sources.items()})
+
+    def _scatter_gated(self, outputs):
+        outputs = iter(outputs)
+        scattered = []
+        for (rows, num_rows) in zip(*self._gate):
+            if len(rows) == 0:
+                scattered.append(GatedColumn(None, rows, num_rows))
+                continue
+            output = next(outputs)
+            if output is not None and not isinstance(output, DataSource):
+                raise Exception('Pipeline output cannot be scattered back to the gate')
+            scattered.append(GatedColumn(output, rows, num_rows) if output is not None else None)
+        return scattered
+
+    def build_sources(self,
+                      videos=None,
+                      frames=None,
+                      gate=None,
+                      gate_min_score=0.0,
+                      gate_labels=None,
+                      **kwargs):
+        """
+        If gate is given, as one bbox column per video or True to use the bboxes source, only
+        frames with at least one box scoring at least gate_min_score (and with a label in
+        gate_labels, if given) are run. Row-aligned sources like bboxes are narrowed to match,
+        and outputs are scattered back to the rows of the gate.
+
+        Row i of the gate is frame frames[i] of its video, or frame i if frames is not given, in
+        which case the gate must have one row per frame.
+        """
         sources = {}
 
+        gate_all_frames = gate is not None and frames is None
+        if gate is not None:
+            videos, frames, kwargs = self._apply_gate(
+                videos, frames, kwargs, gate, gate_min_score, gate_labels)
+
         self._ingest(videos)
 
+        if gate_all_frames:
+            num_rows = [n for (rows, n) in zip(*self._gate) if len(rows) > 0]
+            for (video, n) in zip(videos, num_rows):
+                num_frames = self._db.table(video.scanner_name()).num_rows()
+                if n != num_frames:
+                    raise Exception(
+                        'Gate for video {} has {} rows, but the video has {} frames. Pass the '
+                        'frames the gate was computed on.'.format(video.scanner_name(), n,
+                                                                   num_frames))
+
         frame = self._db.sources.FrameColumn()
         sources['frame'] = BoundOp(
             op=frame, args=[self._db.table(v.scanner_name()).column('frame') for v in videos])
@@ -267,9 +562,17 @@ class Pipeline(ABC):
             sources['frame_sampled'] = BoundOp(
                 op=frame_sampled, args=[1 for _ in range(len(videos))])
 
+        if len(videos) == 0:
+            # Nothing to run, e.g. if no frame passed the gate, so there are no source columns to
+            # build ops from
+            return sources
+
         for k, v in kwargs.items():
             source = v[0].scanner_source(self._db)
             sources[k] = BoundOp(op=source, args=[c.scanner_args(self._db) for c in v])
+            if gate is not None:
+                sources[k + '_ungated'] = sources[k]
+                sources[k] = BoundOp(op=self._db.streams.Gather(source), args=self._gate_rows)
 
         return sources
 
@@ -304,16 +607,20 @@ class Pipeline(ABC):
 
         self._sources = self.build_sources(**source_args)
 
+        if len(self._sources['frame'].args) == 0:
+            return self._scatter_gated([]) if self._gate is not None else []
+
         self._output_ops = self.build_pipeline(**pipeline_args)
 
         self._sink = self.build_sink(**sink_args)
 
         jobs = self._build_jobs()
 
-        if not no_execute:
+        if not no_execute and len(jobs) > 0:
             self._db.run(self._sink.op, jobs, force=True, **{**self.run_opts, **run_opts})
 
-        return self.parse_output(**output_args)
+        outputs = self.parse_output(**output_args)
+        return self._scatter_gated(outputs) if self._gate is not None else outputs
 
     @classmethod
     def make_runner(cls):
@@ -323,7 +630,10 @@ class Pipeline(ABC):
             def method_arg_names(f):
                 return list(inspect.signature(f).parameters.keys())
 
-            source_arg_names = pipeline.base_sources + pipeline.additional_sources + method_arg_names(pipeline.build_sources)
+            # Overrides of build_sources may not list every argument of the base implementation
+            # (e.g. gate), but pass them through in **kwargs
+            source_arg_names = pipeline.base_sources + pipeline.additional_sources + \
+                method_arg_names(pipeline.build_sources) + method_arg_names(Pipeline.build_sources)
             pipeline_arg_names = method_arg_names(pipeline.build_pipeline)
             sink_arg_names = method_arg_names(pipeline.build_sink)
             output_arg_names = method_arg_names(pipeline.parse_output)
@@ -371,10 +681,172 @@ class VideoOutputPipeline(Pipeline):
 
         return paths
 
-def par_for(f, l, process=False, workers=None, progress=True):
+class ParForError(Exception):
+    """
+    Raised by par_for when f fails, carrying the index and value of the failing item.
+    """
+
+    def __init__(self, index, item, tb):
+        super().__init__('par_for failed on item {}:\n{}'.format(index, tb))
+        self.index = index
+        self.item = item
+
+
+class _SharedArray:
+    """
+    Handle to an ndarray stored as a .npy file in shared memory (/dev/shm).
+    """
+
+    def __init__(self, path):
+        self.path = path
+
+
+def _shm_dir():
+    return '/dev/shm' if os.path.isdir('/dev/shm') else tempfile.gettempdir()
+
+
+def _rebuild(obj, items):
+    # Namedtuples take their fields as positional arguments
+    return type(obj)(*items) if isinstance(obj, tuple) and hasattr(obj, '_fields') \
+        else type(obj)(items)
+
+
+def _share_arrays(obj):
+    # Replace every ndarray in obj (possibly nested in tuples, lists or dicts) with a _SharedArray
+    if isinstance(obj, np.ndarray) and obj.dtype != np.object_:
+        with tempfile.NamedTemporaryFile(suffix='.npy', dir=_shm_dir(), delete=False) as f:
+            np.save(f, obj)
+        return _SharedArray(f.name)
+    elif isinstance(obj, (tuple, list)):
+        return _rebuild(obj, [_share_arrays(x) for x in obj])
+    elif isinstance(obj, dict):
+        return {k: _share_arrays(v) for k, v in obj.items()}
+    else:
+        return obj
+
+
+def _load_arrays(obj, copy):
+    if isinstance(obj, _SharedArray):
+        # Copy-on-write mapping lets the worker read without copying and still modify its input
+        return np.load(obj.path, mmap_mode=None if copy else 'c')
+    elif isinstance(obj, (tuple, list)):
+        return _rebuild(obj, [_load_arrays(x, copy) for x in obj])
+    elif isinstance(obj, dict):
+        return {k: _load_arrays(v, copy) for k, v in obj.items()}
+    else:
+        return obj
+
+
+def _unlink_arrays(obj):
+    if isinstance(obj, _SharedArray):
+        if os.path.isfile(obj.path):
+            os.remove(obj.path)
+    elif isinstance(obj, (tuple, list)):
+        for x in obj:
+            _unlink_arrays(x)
+    elif isinstance(obj, dict):
+        for x in obj.values():
+            _unlink_arrays(x)
+
+
+def _par_for_chunk(f, start, items, shared):
+    results = []
+    for i, item in enumerate(items):
+        try:
+            if shared:
+                results.append(_share_arrays(f(_load_arrays(item, copy=False))))
+            else:
+                results.append(f(item))
+        except Exception as e:
+            # Stop at the first failure, and return the results so far so they can be cleaned up
+            return results, (start + i, e, traceback.format_exc())
+    return results, None
+
+
+def par_for_iter(f, l, process=False, workers=None, chunksize=1, shared_memory=False):
+    """
+    Applies f to every item of l in parallel, yielding results in order as they become available.
+
+    l is consumed lazily and only a bounded number of chunks are in flight at once, so results can
+    be consumed (and inputs produced) without materializing everything in memory.
+
+    Args:
+        f (Callable): Function to apply. Must be picklable if process is True.
+        l (Iterable): Items to process.
+        process (bool, optional): Use a process pool instead of a thread pool.
+        workers (int, optional): Number of workers, defaults to the number of CPUs.
+        chunksize (int, optional): Number of items sent to a worker at a time.
+        shared_memory (bool, optional): With a process pool, send ndarrays in the items and results
+            through shared memory instead of pickling them.
+
+    Raises:
+        ParForError: if f raises on any item.
+    """
+
+    l = iter(l)
+    workers = mp.cpu_count() if workers is None else workers
+    shared = process and shared_memory
     Pool = ProcessPoolExecutor if process else ThreadPoolExecutor
-    with Pool(max_workers=mp.cpu_count() if workers is None else workers) as executor:
-        if progress:
-            return list(tqdm(executor.map(f, l), total=len(l)))
-        else:
-            return list(executor.map(f, l))
+
+    with Pool(max_workers=workers) as executor:
+        # Per chunk in flight: its first index, its original items (to report failures), the
+        # items sent to the worker, and the future
+        pending = deque()
+        next_start = 0
+
+        def submit():
+            nonlocal next_start
+            originals = list(islice(l, chunksize))
+            if len(originals) == 0:
+                return
+            start = next_start
+            next_start += len(originals)
+            items = [_share_arrays(item) for item in originals] if shared else originals
+            pending.append(
+                (start, originals, items, executor.submit(_par_for_chunk, f, start, items, shared)))
+
+        for _ in range(workers * 2):
+            submit()
+
+        try:
+            while len(pending) > 0:
+                start, originals, items, future = pending[0]
+                results, error = future.result()
+                pending.popleft()
+
+                if shared:
+                    _unlink_arrays(items)
+                    loaded = [_load_arrays(r, copy=True) for r in results]
+                    _unlink_arrays(results)
+                    results = loaded
+
+                if error is not None:
+                    (index, e, tb) = error
+                    raise ParForError(index, originals[index - start], tb) from e
+
+                submit()
+                for result in results:
+                    yield result
+        finally:
+            # Clean up shared memory for any chunks still in flight, e.g. after an error
+            for (_, _, items, future) in pending:
+                future.cancel()
+                if shared:
+                    if not future.cancelled() and future.exception() is None:
+                        _unlink_arrays(future.result()[0])
+                    _unlink_arrays(items)
+
+
+def par_for(f, l, process=False, workers=None, progress=True, chunksize=1, shared_memory=False):
+    """
+    Applies f to every item of l in parallel and returns the list of results.
+
+    See par_for_iter for a description of the arguments.
+    """
+
+    it = par_for_iter(
+        f, l, process=process, workers=workers, chunksize=chunksize, shared_memory=shared_memory)
+    if progress:
+        return list(tqdm(it, total=len(l) if hasattr(l, '__len__') else None))
+    else:
+        return list(it)
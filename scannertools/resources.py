@@ -0,0 +1,228 @@
+from .prelude import log, par_for
+from attr import attrs, attrib
+from contextlib import contextmanager
+import hashlib
+import tarfile
+import zipfile
+import fcntl
+import os
+
+CHUNK_SIZE = 1 << 20
+RETRIES = 3
+
+# Environment variables, so that every process on a node (including Scanner workers) agrees on
+# the cache location and mode without any extra configuration.
+CACHE_DIR_ENV = 'SCANNERTOOLS_CACHE'
+OFFLINE_ENV = 'SCANNERTOOLS_OFFLINE'
+
+_offline = None
+
+
+def cache_dir():
+    """
+    Returns:
+        str: Directory where downloaded resources are cached. Defaults to ~/.scanner/resources, and
+        can be overridden with the SCANNERTOOLS_CACHE environment variable.
+    """
+    return os.path.expanduser(os.environ.get(CACHE_DIR_ENV, '~/.scanner/resources'))
+
+
+def set_offline(offline):
+    """
+    Enables or disables offline mode for this process. In offline mode, resources are never
+    downloaded, and cached resources must match their checksum.
+    """
+    global _offline
+    _offline = offline
+
+
+def is_offline():
+    if _offline is not None:
+        return _offline
+    return os.environ.get(OFFLINE_ENV, '0') not in ['', '0']
+
+
+def sha256sum(path):
+    h = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for block in iter(lambda: f.read(CHUNK_SIZE), b''):
+            h.update(block)
+    return h.hexdigest()
+
+
+@contextmanager
+def _file_lock(path):
+    # flock is advisory and per open file, so it serializes both threads and processes
+    with open(path + '.lock', 'w') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+@attrs(frozen=True)
+class Resource:
+    """
+    Manifest entry for a file (e.g. model weights) that a pipeline needs.
+
+    If sha256 or size are not provided, the checksum of the first download is recorded next to the
+    file and used to verify it from then on.
+    """
+
+    url = attrib(type=str)
+    sha256 = attrib(type=str, default=None)
+    size = attrib(type=int, default=None)
+
+    # Path relative to the cache directory. Defaults to the file name in the URL.
+    path = attrib(type=str, default=None)
+
+    # If true, the archive (tar or zip) is extracted next to the downloaded file, and fetch returns
+    # the containing directory instead of the archive path.
+    untar = attrib(type=bool, default=False)
+
+    def local_path(self):
+        return os.path.join(cache_dir(), self.path or self.url.rsplit('/', 1)[-1])
+
+    def fetch(self):
+        """
+        Downloads the resource into the cache if needed, and verifies it.
+
+        Safe to call concurrently from many threads and processes sharing the cache directory.
+
+        Returns:
+            str: Local path to the resource (or the directory it was extracted into).
+        """
+
+        path = self.local_path()
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+
+        with _file_lock(path):
+            if os.path.isfile(path):
+                self._check_cached(path)
+            elif is_offline():
+                raise Exception('Resource {} is not cached at {} and offline mode is enabled'.format(
+                    self.url, path))
+            else:
+                self._download(path)
+
+            if self.untar:
+                return self._extract(path)
+
+        return path
+
+    def _expected_sha256(self, path):
+        if self.sha256 is not None:
+            return self.sha256
+        if os.path.isfile(path + '.sha256'):
+            with open(path + '.sha256') as f:
+                return f.read().strip()
+        return None
+
+    def _check_cached(self, path):
+        if self.size is not None and os.path.getsize(path) != self.size:
+            raise Exception('Cached resource {} has size {}, expected {}'.format(
+                path, os.path.getsize(path), self.size))
+
+        # Hashing large models on every fetch is expensive, so only do it when we can't fall back
+        # to the network anyway
+        if is_offline():
+            expected = self._expected_sha256(path)
+            if expected is None:
+                raise Exception('Cached resource {} has no known checksum to verify'.format(path))
+            if sha256sum(path) != expected:
+                raise Exception('Cached resource {} does not match its checksum'.format(path))
+
+    def _download(self, path):
+        import requests
+
+        part_path = path + '.part'
+        for attempt in range(RETRIES):
+            try:
+                self._download_part(part_path)
+                break
+            except requests.exceptions.RequestException as e:
+                if attempt == RETRIES - 1:
+                    raise
+                log.warning('Download of {} interrupted ({}), resuming'.format(self.url, e))
+
+        if self.size is not None and os.path.getsize(part_path) != self.size:
+            size = os.path.getsize(part_path)
+            os.remove(part_path)
+            raise Exception('Downloaded {} has size {}, expected {}'.format(self.url, size,
+                                                                            self.size))
+
+        digest = sha256sum(part_path)
+        if self.sha256 is not None and digest != self.sha256:
+            os.remove(part_path)
+            raise Exception('Downloaded {} has sha256 {}, expected {}'.format(
+                self.url, digest, self.sha256))
+
+        with open(path + '.sha256', 'w') as f:
+            f.write(digest)
+        os.rename(part_path, path)
+
+    def _download_part(self, part_path):
+        import requests
+
+        # Resume from a previous partial download if the server supports range requests
+        offset = os.path.getsize(part_path) if os.path.isfile(part_path) else 0
+        headers = {'Range': 'bytes={}-'.format(offset)} if offset > 0 else {}
+
+        log.debug('Downloading {}'.format(self.url))
+        resp = requests.get(self.url, headers=headers, stream=True, timeout=60)
+        if resp.status_code == 416 and offset > 0:
+            # Partial file is already complete
+            return
+        resp.raise_for_status()
+        if resp.status_code != 206:
+            offset = 0
+
+        with open(part_path, 'ab' if offset > 0 else 'wb') as f:
+            for block in resp.iter_content(CHUNK_SIZE):
+                f.write(block)
+
+    def _extract(self, path):
+        directory = os.path.dirname(path)
+        marker = path + '.extracted'
+        if not os.path.isfile(marker):
+            with (zipfile.ZipFile(path) if zipfile.is_zipfile(path) else tarfile.open(path)) as f:
+                f.extractall(directory)
+            open(marker, 'w').close()
+        return directory
+
+
+def fetch_all(resources, workers=None):
+    """
+    Fetches many resources in parallel.
+
+    Args:
+        resources (Dict[str, Resource]): Resources to fetch, by name.
+        workers (int, optional): Maximum number of concurrent downloads.
+
+    Returns:
+        Dict[str, str]: Local path of each resource, by name.
+    """
+
+    names = list(resources.keys())
+    if len(names) == 0:
+        return {}
+
+    paths = par_for(
+        lambda name: resources[name].fetch(),
+        names,
+        workers=workers if workers is not None else len(names),
+        progress=False)
+    return dict(zip(names, paths))
+
+
+def prefetch(pipelines, workers=None):
+    """
+    Fetches the resources of every given Pipeline class in parallel, e.g. when a worker starts.
+    """
+
+    resources = {}
+    for pipeline in pipelines:
+        for name, resource in pipeline.resources.items():
+            resources['{}.{}'.format(pipeline.__name__, name)] = resource
+    return fetch_all(resources, workers=workers)
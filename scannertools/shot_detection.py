@@ -1,13 +1,42 @@
 from .prelude import *
-from scipy.spatial import distance
+from typing import Sequence
 import numpy as np
 
 WINDOW_SIZE = 500
 
+# Per-frame difference score computed on the workers: the Chebyshev distance between the
+# histograms of a frame and the previous one, summed over the color channels
+SHOT_DIFF_CODEC = register_codec('shot_diffs', '<i4', counted=False)
 
-class ShotDetectionPipeline(Pipeline):
+
+def histogram_diffs(hists):
+    """
+    Computes the difference score of each pair of adjacent histograms.
+
+    Args:
+        hists (np.array): (N x 3 x bins) array of per-channel histograms.
+
+    Returns:
+        np.array: (N-1) array of Chebyshev distances between adjacent histograms, summed over
+        the color channels.
+    """
+    return np.abs(np.diff(np.asarray(hists, dtype=np.int64), axis=0)).max(axis=2).sum(axis=1)
+
+
+@scannerpy.register_python_op(name='HistogramDiff', stencil=[-1, 0])
+class HistogramDiff(scannerpy.Kernel):
+    def __init__(self, config):
+        self._config = config
+
+    def execute(self, histogram: Sequence[bytes]) -> bytes:
+        # The first frame has no predecessor, so its score is ignored by the client
+        hists = np.stack([HISTOGRAM_CODEC.decode(h) for h in histogram])
+        return SHOT_DIFF_CODEC.encode(histogram_diffs(hists))
+
+
+class HistogramPipeline(Pipeline):
     job_suffix = 'hist'
-    parser_fn = lambda _: readers.histograms
+    parser_fn = lambda _: HISTOGRAM_CODEC.decode
 
     def build_pipeline(self):
         return {
@@ -17,28 +46,151 @@ class ShotDetectionPipeline(Pipeline):
                 device=DeviceType.CPU if self._cpu_only else DeviceType.GPU)
         }
 
+
+class ShotDetectionPipeline(HistogramPipeline):
+    _streaming = False
+    _stride = 1
+    parser_fn = lambda self: SHOT_DIFF_CODEC.decode if self._streaming else HISTOGRAM_CODEC.decode
+
+    def build_sources(self,
+                      videos=None,
+                      frames=None,
+                      stride=1,
+                      gate=None,
+                      gate_min_score=0.0,
+                      gate_labels=None,
+                      **kwargs):
+        """
+        With a gate, shots are detected over the frames that passed it, and boundaries are
+        returned as rows of the gate.
+        """
+        if stride > 1 and (frames is not None or gate is not None):
+            raise Exception('stride cannot be combined with frames or gate')
+
+        sources = super().build_sources(
+            videos=videos,
+            frames=frames,
+            gate=gate,
+            gate_min_score=gate_min_score,
+            gate_labels=gate_labels,
+            **kwargs)
+        self._videos = videos
+        self._stride = stride
+        if stride > 1:
+            sources['frame_sampled'] = BoundOp(
+                op=sources['frame_sampled'].op, args=[stride for _ in range(len(videos))])
+        return sources
+
+    def build_pipeline(self, streaming=False):
+        self._streaming = streaming
+        histogram = super().build_pipeline()['histogram']
+
+        if streaming:
+            # Only the per-frame scores are stored and sent to the client, not the histograms
+            self.job_suffix = 'shotdiff'
+            return {'diff': self._db.ops.HistogramDiff(histogram=histogram)}
+        else:
+            return {'histogram': histogram}
+
     def _compute_shot_boundaries(self, hists):
-        # Compute the mean difference between each pair of adjacent frames
-        diffs = np.array([
-            np.mean([distance.chebyshev(hists[i - 1][j], hists[i][j]) for j in range(3)])
-            for i in range(1, len(hists))
-        ])
-        diffs = np.insert(diffs, 0, 0)
+        if len(hists) < 2:
+            return []
+
+        return self._diff_boundaries(np.insert(histogram_diffs(hists), 0, 0))
+
+    def _diff_boundaries(self, diffs):
+        # Compute the mean difference between each pair of adjacent frames, i.e. the Chebyshev
+        # distance between their histograms averaged over the color channels
+        diffs = diffs / 3
         n = len(diffs)
+        if n < 2:
+            return []
 
-        # Do simple outlier detection to find boundaries between shots
-        boundaries = []
-        for i in range(1, n):
-            window = diffs[max(i - WINDOW_SIZE, 0):min(i + WINDOW_SIZE, n)]
-            if diffs[i] - np.mean(window) > 3 * np.std(window):
-                boundaries.append(i)
-        return boundaries
+        # Do simple outlier detection to find boundaries between shots. The windowed mean and
+        # standard deviation come from cumulative sums, centered to limit cancellation.
+        idx = np.arange(1, n)
+        lo = np.maximum(idx - WINDOW_SIZE, 0)
+        hi = np.minimum(idx + WINDOW_SIZE, n)
+        count = hi - lo
+        centered = diffs - diffs.mean()
+        sums = np.concatenate([[0], np.cumsum(centered)])
+        sq_sums = np.concatenate([[0], np.cumsum(centered**2)])
+        mean = (sums[hi] - sums[lo]) / count
+        std = np.sqrt(np.maximum((sq_sums[hi] - sq_sums[lo]) / count - mean**2, 0))
+        margin = centered[idx] - mean - 3 * std
+
+        # Frames too close to the threshold for the rolling statistics to decide are rechecked
+        # directly, so the result is the same as comparing against np.mean/np.std of the window
+        tolerance = 1e-6 * (np.abs(diffs).max() + 1)
+        boundaries = margin > tolerance
+        for j in np.nonzero(np.abs(margin) <= tolerance)[0]:
+            window = diffs[lo[j]:hi[j]]
+            boundaries[j] = diffs[idx[j]] - np.mean(window) > 3 * np.std(window)
+        return idx[boundaries].tolist()
+
+    def _load_boundaries(self, column):
+        if self._streaming:
+            diffs = np.concatenate([np.zeros(1)] + list(column.load()))[1:]
+            diffs[:1] = 0
+            return self._diff_boundaries(diffs)
+        else:
+            return self._compute_shot_boundaries(list(column.load()))
+
+    def _refine_boundaries(self, all_boundaries):
+        # Each boundary k found at the coarse stride s lies somewhere in frames ((k-1)s, ks], so
+        # histogram every frame in those intervals and take the largest adjacent difference
+        s = self._stride
+        intervals = [[(k * s - s, k * s) for k in boundaries]
+                     if boundaries is not None else [] for boundaries in all_boundaries]
+        to_refine = [i for i in range(len(intervals)) if len(intervals[i]) > 0]
+        if len(to_refine) == 0:
+            return [[] if b is not None else None for b in all_boundaries]
+
+        # Adjacent intervals share an endpoint, so gather each frame only once
+        frames = [
+            sorted(set(f for (start, end) in intervals[i] for f in range(start, end + 1)))
+            for i in to_refine
+        ]
+        pipeline = HistogramPipeline(self._db)
+        pipeline.job_suffix = 'hist_refine'
+        all_hists = pipeline.execute(
+            source_args={'videos': [self._videos[i] for i in to_refine], 'frames': frames},
+            cpu_only=self._cpu_only)
+
+        refined = [[] if b is not None else None for b in all_boundaries]
+        for (i, vid_frames, vid_hists) in zip(to_refine, frames, all_hists):
+            if vid_hists is None:
+                refined[i] = None
+                continue
+            hists = np.asarray(list(vid_hists.load()))
+            rows = np.searchsorted(vid_frames, [start for (start, _) in intervals[i]])
+            refined[i] = [
+                start + 1 + int(np.argmax(histogram_diffs(hists[row:row + s + 1])))
+                for ((start, _), row) in zip(intervals[i], rows)
+            ]
+        return refined
 
     def parse_output(self):
         all_hists = super().parse_output()
-        return par_for(
-            lambda vid_hists: self._compute_shot_boundaries(list(vid_hists.load())) if vid_hists is not None else None,
+        all_boundaries = par_for(
+            lambda vid_hists: self._load_boundaries(vid_hists) if vid_hists is not None else None,
             all_hists)
+        if self._stride > 1:
+            all_boundaries = self._refine_boundaries(all_boundaries)
+        return all_boundaries
+
+    def _scatter_gated(self, outputs):
+        # Boundaries are positions among the frames that passed the gate, so map them back to
+        # rows of the gate instead of scattering
+        outputs = iter(outputs)
+        boundaries = []
+        for (rows, _) in zip(*self._gate):
+            if len(rows) == 0:
+                boundaries.append([])
+                continue
+            output = next(outputs)
+            boundaries.append([rows[b] for b in output] if output is not None else None)
+        return boundaries
 
 
 detect_shots = ShotDetectionPipeline.make_runner()
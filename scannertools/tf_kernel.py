@@ -0,0 +1,67 @@
+from scannerpy.stdlib.tensorflow import TensorFlowKernel
+import threading
+
+# Models loaded in this process, keyed by (model name, model key, devices). Each key has its own
+# lock, so different models load concurrently while instances of the same model wait for it.
+_models = {}
+_model_locks = {}
+_models_lock = threading.Lock()
+
+
+class SharedTensorFlowKernel(TensorFlowKernel):
+    """
+    TensorFlow kernel whose model is loaded when the kernel is created rather than on its first
+    batch, and shared by every instance in the process that loads the same model on the same
+    devices.
+
+    The first instance builds the graph and session, loads the model with load_model, and runs
+    warm_up so the first batch doesn't pay for TensorFlow's lazy initialization. Later instances
+    reuse the graph, session and model.
+
+    Subclasses implement build_graph, load_model and optionally warm_up, and set model_name.
+    The loaded model is available as self.model.
+    """
+
+    model_name = None
+
+    def __init__(self, config):
+        self.config = config
+        key = (self.model_name or type(self).__name__, self.model_key(),
+               tuple((d.type, d.id) for d in config.devices))
+        with _models_lock:
+            lock = _model_locks.setdefault(key, threading.Lock())
+        with lock:
+            if key not in _models:
+                TensorFlowKernel.__init__(self, config)
+                with self.graph.as_default():
+                    with self.sess.as_default():
+                        self.model = self.load_model()
+                        self.warm_up()
+                _models[key] = (self.graph, self.sess, self.model)
+        (self.graph, self.sess, self.model) = _models[key]
+
+    def model_key(self):
+        """
+        Returns:
+            Hashable: Identifies the model among those with the same model_name.
+        """
+        return self.config.args.get('model_dir')
+
+    def load_model(self):
+        """
+        Loads the model into self.graph and self.sess.
+
+        Returns:
+            Any: The model, e.g. its input and output tensors.
+        """
+        return None
+
+    def warm_up(self):
+        """
+        Runs a first inference on dummy inputs.
+        """
+        pass
+
+    def close(self):
+        # The session is shared with other instances, so it's kept until the process exits
+        pass
@@ -2,9 +2,9 @@ from .prelude import *
 import pickle
 import scannerpy
 from scannerpy.stdlib import readers, writers
-from scannerpy.stdlib.util import default, temp_directory, download_temp_file
-from scannerpy.stdlib.bboxes import proto_to_np
+from scannerpy.stdlib.util import default
 from scannertools import tf_vis_utils
+from .resources import Resource
 import numpy as np
 import os
 import cv2
@@ -42,19 +42,15 @@ class BboxDraw(scannerpy.Kernel):
         self._config = config
 
     def execute(self, frame: FrameType, bboxes: bytes) -> FrameType:
-        bboxes = readers.bboxes(bboxes, self._config.protobufs)
+        bboxes = BBOX_CODEC.decode(bboxes, self._config.protobufs)
         if len(bboxes) == 0:
             return frame
 
-        bboxes = proto_to_np(bboxes)
-        bboxes[:, [0, 1]] = bboxes[:, [1, 0]]
-        bboxes[:, [2, 3]] = bboxes[:, [3, 2]]
-
         return tf_vis_utils.visualize_boxes_and_labels_on_image_array(
             frame,
-            bboxes[:, :4],
-            bboxes[:, 5].astype(np.int32),
-            bboxes[:, 4],
+            np.stack([bboxes.y1, bboxes.x1, bboxes.y2, bboxes.x2], axis=1),
+            bboxes.label.astype(np.int32),
+            bboxes.score,
             self._category_index,
             use_normalized_coordinates=True,
             line_thickness=8,
@@ -64,11 +60,16 @@ class BboxDraw(scannerpy.Kernel):
 class DrawBboxesPipeline(VideoOutputPipeline):
     job_suffix = 'draw_bboxes'
     additional_sources = ['bboxes']
+    resources = {
+        'labels':
+        Resource(
+            'https://raw.githubusercontent.com/tensorflow/models/master/research/object_detection/data/mscoco_label_map.pbtxt',
+            path='tf_models/mscoco_label_map.pbtxt')
+    }
 
     def fetch_resources(self):
-        self._label_path = download_temp_file(
-            'https://raw.githubusercontent.com/tensorflow/models/master/research/object_detection/data/mscoco_label_map.pbtxt'
-        )
+        super().fetch_resources()
+        self._label_path = self._resource_paths['labels']
 
     def build_pipeline(self):
         return {
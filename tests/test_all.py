@@ -4,9 +4,16 @@ from scannertools import *
 import scannerpy
 import os
 import subprocess as sp
+import sys
 import tempfile
 import toml
 import shutil
+import threading
+import collections
+import hashlib
+from http.server import HTTPServer, BaseHTTPRequestHandler
+from scannertools import resources, pose_detection, shot_detection, object_detection, \
+    gender_detection, face_detection, face_embedding, optical_flow, clothing_detection
 
 # TODO: test output on all the pipelines
 
@@ -48,6 +55,286 @@ def db():
     shutil.rmtree(cfg['storage']['db_path'])
 
 
+class RangeRequestHandler(BaseHTTPRequestHandler):
+    files = {}
+
+    def do_GET(self):
+        if self.path not in self.files:
+            self.send_error(404)
+            return
+        data = self.files[self.path]
+        start = 0
+        if 'Range' in self.headers:
+            start = int(self.headers['Range'].split('=')[1].split('-')[0])
+            self.send_response(206)
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.end_headers()
+        self.wfile.write(data[start:])
+
+    def log_message(self, *args):
+        pass
+
+
+@pytest.fixture(scope='module')
+def http_server():
+    import io
+    import zipfile
+    RangeRequestHandler.files['/model.bin'] = os.urandom(100000)
+    archive = io.BytesIO()
+    with zipfile.ZipFile(archive, 'w') as f:
+        f.writestr('model/weights.bin', b'weights')
+    RangeRequestHandler.files['/model.zip'] = archive.getvalue()
+    server = HTTPServer(('localhost', 0), RangeRequestHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    yield 'http://localhost:{}'.format(server.server_port)
+    server.shutdown()
+
+
+@pytest.fixture
+def resource_cache(tmpdir, monkeypatch):
+    monkeypatch.setenv(resources.CACHE_DIR_ENV, str(tmpdir))
+    yield str(tmpdir)
+    resources.set_offline(None)
+
+
+def test_resource_fetch(http_server, resource_cache):
+    data = RangeRequestHandler.files['/model.bin']
+    res = resources.Resource(
+        http_server + '/model.bin', sha256=hashlib.sha256(data).hexdigest(), size=len(data))
+    paths = resources.fetch_all({'a': res, 'b': res})
+    assert paths['a'] == paths['b'] == os.path.join(resource_cache, 'model.bin')
+    with open(paths['a'], 'rb') as f:
+        assert f.read() == data
+
+    with pytest.raises(Exception):
+        resources.Resource(http_server + '/model.bin', sha256='0' * 64, path='bad.bin').fetch()
+    assert not os.path.isfile(os.path.join(resource_cache, 'bad.bin'))
+
+
+def test_resource_resume(http_server, resource_cache):
+    data = RangeRequestHandler.files['/model.bin']
+    with open(os.path.join(resource_cache, 'model.bin.part'), 'wb') as f:
+        f.write(data[:1000])
+    path = resources.Resource(http_server + '/model.bin').fetch()
+    with open(path, 'rb') as f:
+        assert f.read() == data
+
+
+def test_resource_untar(http_server, resource_cache):
+    path = resources.Resource(http_server + '/model.zip', untar=True).fetch()
+    with open(os.path.join(path, 'model', 'weights.bin'), 'rb') as f:
+        assert f.read() == b'weights'
+
+
+def test_resource_offline(http_server, resource_cache):
+    res = resources.Resource(http_server + '/model.bin')
+    resources.set_offline(True)
+    with pytest.raises(Exception):
+        res.fetch()
+
+    resources.set_offline(False)
+    path = res.fetch()
+
+    resources.set_offline(True)
+    assert res.fetch() == path
+    with open(path, 'ab') as f:
+        f.write(b'corrupt')
+    with pytest.raises(Exception):
+        res.fetch()
+
+
+def test_lazy_import():
+    out = sp.check_output([
+        sys.executable, '-c', 'import scannertools, sys; '
+        'print("scannertools.shot_detection" in sys.modules); '
+        'scannertools.shot_detection.detect_shots; '
+        'print("scannertools.shot_detection" in sys.modules)'
+    ])
+    assert out.decode('utf-8').split() == ['False', 'True']
+
+    # A star import only brings in the eagerly loaded names
+    out = sp.check_output([
+        sys.executable, '-c', 'from scannertools import *; import scannertools, sys; '
+        'print(any(m.split(".")[-1] in scannertools.LAZY_SUBMODULES for m in sys.modules '
+        'if m.startswith("scannertools."))); print("Video" in dir())'
+    ])
+    assert out.decode('utf-8').split() == ['False', 'True']
+
+
+def _double(arr):
+    return arr * 2
+
+
+Pair = collections.namedtuple('Pair', ['first', 'second'])
+
+
+def _swap(pair):
+    return Pair(pair.second, pair.first)
+
+
+def _fail_on_seven(x):
+    if x == 7:
+        raise ValueError()
+    return x
+
+
+def test_par_for():
+    import numpy as np
+    from scannertools.prelude import par_for, par_for_iter, ParForError
+
+    arrs = [np.full((100, 100), i) for i in range(10)]
+    results = par_for(
+        _double, arrs, process=True, shared_memory=True, chunksize=3, progress=False)
+    assert all((r == a * 2).all() for (r, a) in zip(results, arrs))
+
+    pairs = [Pair(a, i) for (i, a) in enumerate(arrs)]
+    results = par_for(_swap, pairs, process=True, shared_memory=True, progress=False)
+    for (i, (r, a)) in enumerate(zip(results, arrs)):
+        assert isinstance(r, Pair) and r.first == i and (r.second == a).all()
+
+    with pytest.raises(ParForError) as exc:
+        par_for(_fail_on_seven, list(range(10)), chunksize=4, progress=False)
+    assert exc.value.index == 7 and exc.value.item == 7
+
+    # Inputs are only consumed as chunks are submitted
+    consumed = []
+
+    def items():
+        for i in range(1000):
+            consumed.append(i)
+            yield i
+
+    it = par_for_iter(_double, items(), workers=2, chunksize=2)
+    assert next(it) == 0 and len(consumed) < 100
+    assert list(it) == [2 * i for i in range(1, 1000)]
+    with pytest.raises(ParForError) as exc:
+        par_for(_fail_on_seven, iter(range(10)), chunksize=4, progress=True)
+    assert exc.value.index == 7 and exc.value.item == 7
+
+
+def test_nms():
+    import numpy as np
+    from scannertools.bboxes import nms
+
+    boxes = np.array([
+        [0.0, 0.0, 0.5, 0.5, 0.9, 1],
+        [0.05, 0.05, 0.5, 0.5, 0.8, 1],
+        [0.05, 0.05, 0.5, 0.5, 0.7, 2],
+        [0.6, 0.6, 0.9, 0.9, 0.6, 1],
+    ])
+    keep, _ = nms(boxes, 0.5)
+    assert list(keep) == [0, 2, 3]
+
+    keep, _ = nms(boxes, 0.5, class_aware=False)
+    assert list(keep) == [0, 3]
+
+    keep, scores = nms(boxes, 0.5, soft=True)
+    assert list(keep) == [0, 2, 3, 1] and scores[3] < 0.8
+
+
+def test_codec():
+    import numpy as np
+    from scannertools.prelude import BBOX_CODEC, get_codec
+
+    buf = BBOX_CODEC.encode_columns(
+        x1=[0.1, 0.2], y1=[0.1, 0.2], x2=[0.3, 0.4], y2=[0.3, 0.4], score=[0.9, 0.5], label=[1, 3])
+    bboxes = BBOX_CODEC.decode(buf)
+    assert len(bboxes) == 2 and bboxes[1].label == 3
+    assert np.allclose(bboxes.score, [0.9, 0.5])
+    assert len(BBOX_CODEC.decode(BBOX_CODEC.encode([]))) == 0
+
+    records, offsets = BBOX_CODEC.decode_many([buf, BBOX_CODEC.encode([]), buf])
+    assert len(records) == 4 and list(offsets) == [0, 2, 2, 4]
+
+    # Rows written before the codec, in Scanner's length-prefixed BoundingBox protobuf format
+    import struct
+    from types import SimpleNamespace
+
+    class BoundingBox:
+        FIELDS = ['x1', 'y1', 'x2', 'y2', 'score', 'label']
+
+        def SerializeToString(self):
+            return struct.pack('=5fi', *[getattr(self, k) for k in self.FIELDS])
+
+        def ParseFromString(self, s):
+            for (k, v) in zip(self.FIELDS, struct.unpack('=5fi', s)):
+                setattr(self, k, v)
+
+    box = BoundingBox()
+    box.ParseFromString(struct.pack('=5fi', 0.1, 0.1, 0.3, 0.3, 0.8, 2))
+    legacy = struct.pack('=QQ', 1, 24) + box.SerializeToString()
+    protobufs = SimpleNamespace(BoundingBox=BoundingBox)
+    bboxes = BBOX_CODEC.decode(legacy, protobufs)
+    assert len(bboxes) == 1 and bboxes[0].label == 2 and np.isclose(bboxes[0].score, 0.8)
+    assert len(BBOX_CODEC.decode(struct.pack('=Q', 0), protobufs)) == 0
+    records, offsets = BBOX_CODEC.decode_many([buf, legacy], protobufs)
+    assert list(records.label) == [1, 3, 2] and list(offsets) == [0, 2, 3]
+
+    import scannertools.face_embedding
+    embeddings = get_codec('embeddings')
+    embs = np.random.rand(3, embeddings.dtype.shape[0]).astype(np.float32)
+    assert (embeddings.decode(embeddings.encode(embs)) == embs).all()
+
+
+def test_shot_boundaries(monkeypatch):
+    import numpy as np
+    from scannertools.prelude import DataSource
+    from scannertools.shot_detection import ShotDetectionPipeline, HistogramPipeline
+
+    rng = np.random.RandomState(0)
+    base = rng.randint(0, 1000, size=(4, 3, 16))
+    hists = base[np.arange(1200) // 300] + rng.randint(0, 20, size=(1200, 3, 16))
+    assert ShotDetectionPipeline(None)._compute_shot_boundaries(hists) == [300, 600, 900]
+
+    # Streaming mode scores each frame on the workers with a [-1, 0] stencil
+    from scannertools.shot_detection import HistogramDiff, SHOT_DIFF_CODEC
+    bufs = [h.astype(np.int32).tobytes() for h in hists]
+    kernel = HistogramDiff(None)
+    diffs = [
+        SHOT_DIFF_CODEC.decode(kernel.execute([bufs[max(i - 1, 0)], bufs[i]]))
+        for i in range(len(bufs))
+    ]
+    assert ShotDetectionPipeline(None)._diff_boundaries(np.concatenate(diffs)) == [300, 600, 900]
+
+    # With a stride, boundaries found between coarse samples are refined to the exact frame
+    cuts = [301, 605, 898]
+    hists = base[np.searchsorted(cuts, np.arange(1200), side='right')] + \
+        rng.randint(0, 20, size=(1200, 3, 16))
+
+    class Rows(DataSource):
+        def __init__(self, rows):
+            self._rows = rows
+
+        def load(self):
+            return iter(self._rows)
+
+    def execute(self, source_args={}, **kwargs):
+        return [Rows(hists[frames]) for frames in source_args['frames']]
+
+    monkeypatch.setattr(HistogramPipeline, 'execute', execute)
+    pipeline = ShotDetectionPipeline(None)
+    pipeline._videos, pipeline._stride, pipeline._cpu_only = ['a', 'b'], 8, True
+    coarse = pipeline._compute_shot_boundaries(hists[::8])
+    assert coarse == [38, 76, 113]
+    assert pipeline._refine_boundaries([coarse, None]) == [cuts, None]
+
+
+def test_clothing_body_bounds():
+    from scannertools.clothing_detection import DetectClothing
+    from types import SimpleNamespace as Box
+
+    bboxes = [
+        Box(x1=0.4, y1=0.1, x2=0.5, y2=0.2),
+        Box(x1=0.42, y1=0.5, x2=0.52, y2=0.6),
+        Box(x1=0.45, y1=0.3, x2=0.55, y2=0.4),
+        Box(x1=0.0, y1=0.7, x2=0.1, y2=0.8)
+    ]
+    assert list(DetectClothing.body_bounds(bboxes)) == [0.3, 1.0, 0.5, 1.0]
+
+
 def test_frame(video):
     frame = video.frame(0)
     assert frame.shape == (video.height(), video.width(), 3)
@@ -79,11 +366,92 @@ def test_object_detection(db, video):
     [bboxes] = object_detection.detect_objects(db, videos=[video], frames=[[0]])
     assert len([bb for bb in next(bboxes.load()) if bb.score > 0.5]) == 1
 
+    [quantized] = object_detection.detect_objects(
+        db, videos=[video], frames=[[0]], backend='quantized')
+    accuracy = object_detection.compare_detections(list(bboxes.load()), list(quantized.load()))
+    assert accuracy['num_reference'] == 1 and accuracy['recall'] == 1.0
+
+
+def test_object_detection_resources(monkeypatch):
+    fetched = []
+    monkeypatch.setattr(resources, 'fetch_all',
+                        lambda r: fetched.append(sorted(r)) or {k: '/models' for k in r})
+    pipeline = object_detection.ObjectDetectionPipeline(None)
+    pipeline._backend = 'quantized'
+    pipeline.fetch_resources()
+    assert fetched == [['quantized_model']]
+    assert pipeline._model_path == os.path.join('/models', object_detection.QUANTIZED_MODEL_FILE)
+
+
+def test_compare_detections():
+    import numpy as np
+    from scannertools.object_detection import compare_detections
+    from scannertools.prelude import BBOX_CODEC
+
+    def bboxes(*boxes):
+        b = np.array(boxes, dtype=np.float64).reshape((-1, 6))
+        return BBOX_CODEC.decode(
+            BBOX_CODEC.encode_columns(
+                x1=b[:, 0], y1=b[:, 1], x2=b[:, 2], y2=b[:, 3], score=b[:, 4], label=b[:, 5]))
+
+    reference = [
+        bboxes((0, 0, 0.5, 0.5, 0.9, 1), (0.5, 0.5, 1, 1, 0.8, 3)),
+        bboxes((0, 0, 1, 1, 0.9, 1))
+    ]
+    candidate = [
+        bboxes((0, 0, 0.5, 0.4, 0.7, 1), (0.5, 0.5, 1, 1, 0.8, 1), (0, 0, 0.1, 0.1, 0.1, 1)),
+        bboxes()
+    ]
+    accuracy = compare_detections(reference, candidate)
+    assert accuracy['precision'] == 0.5 and accuracy['recall'] == 1 / 3
+    assert np.isclose(accuracy['mean_iou'], 0.8) and np.isclose(accuracy['mean_score_diff'], 0.2)
+
+
+def test_face_tracking():
+    import numpy as np
+    import cv2
+    from types import SimpleNamespace
+    from scannertools.face_detection import MTCNNTrackFaces
+    from scannertools.prelude import BBOX_CODEC
+
+    rng = np.random.RandomState(0)
+    background = cv2.GaussianBlur((rng.rand(360, 640, 3) * 255).astype(np.uint8), (5, 5), 1)
+    face = cv2.GaussianBlur((rng.rand(80, 60, 3) * 255).astype(np.uint8), (3, 3), 1)
+    frames = []
+    for t in range(20):
+        img = background.copy()
+        img[100 + t:180 + t, 100 + 3 * t:160 + 3 * t] = face
+        frames.append(img if t != 12 else 255 - img)
+
+    kernel = MTCNNTrackFaces.__new__(MTCNNTrackFaces)
+    kernel.config = SimpleNamespace(args={'detect_every': 8})
+    kernel.reset()
+    detected = []
+
+    def detect(imgs):
+        t = [i for i in range(len(frames)) if frames[i] is imgs[0]][0]
+        detected.append(t)
+        return [(np.array([[100 + 3 * t, 100 + t, 160 + 3 * t, 180 + t, 0.99]]), None)]
+
+    kernel._detect = detect
+    bboxes = [
+        BBOX_CODEC.decode(b) for i in range(0, 20, 4) for b in kernel.execute(frames[i:i + 4])
+    ]
+
+    # Scheduled detections, plus re-detection when the inverted frame breaks tracking
+    assert detected == [0, 8, 12, 13]
+    for t in [5, 19]:
+        assert abs(bboxes[t][0].x2 * 640 - (160 + 3 * t) - (bboxes[0][0].x2 * 640 - 160)) < 1
+
 
 def test_face_detection(db, video):
     [bboxes] = face_detection.detect_faces(db, videos=[video], frames=[[0]])
     assert len([bb for bb in next(bboxes.load()) if bb.score > 0.5]) == 1
 
+    [tracked] = face_detection.detect_faces(
+        db, videos=[video], frames=[list(range(8))], mode='track', detect_every=4)
+    assert len(list(tracked.load())) == 8
+
 
 def test_gender_detection(db, video):
     bboxes = face_detection.detect_faces(db, videos=[video], frames=[[0]])
@@ -102,6 +470,242 @@ def test_face_embedding(db, video):
     embeddings = face_embedding.embed_faces(db, videos=[video], frames=[[0]], bboxes=bboxes)
     next(embeddings[0].load())
 
+    bboxes = face_detection.detect_faces(db, videos=[video], frames=[[0, 1, 2]])
+    embeddings = face_embedding.embed_faces(
+        db, videos=[video], frames=[[0, 1, 2]], bboxes=bboxes, gate=True)
+    assert len(list(embeddings[0].load())) == 3
+
+    [tracked] = face_embedding.embed_faces(
+        db, videos=[video], frames=[[0, 1, 2]], bboxes=bboxes, per_track=1)
+    assert [len(e) for e in tracked.load()] == [len(b) for b in bboxes[0].load()]
+
+    [gated] = face_embedding.embed_faces(
+        db, videos=[video], frames=[[0, 1, 2]], bboxes=bboxes, per_track=1, gate=True)
+    assert [len(e) for e in gated.load()] == [len(b) for b in bboxes[0].load()]
+    [gated] = face_embedding.embed_faces(
+        db,
+        videos=[video],
+        frames=[[0, 1, 2]],
+        bboxes=bboxes,
+        per_track=1,
+        gate=True,
+        gate_min_score=2.0)
+    assert list(gated.load()) == [None, None, None]
+
+    # Videos without any faces are not run
+    from scannertools.prelude import DataSource, BBOX_CODEC
+
+    class Rows(DataSource):
+        def load(self):
+            return iter([BBOX_CODEC.decode(BBOX_CODEC.encode([]))] * 3)
+
+    [empty] = face_embedding.embed_faces(
+        db, videos=[video], frames=[[0, 1, 2]], bboxes=[Rows()], per_track=1)
+    assert [len(e) for e in empty.load()] == [0, 0, 0]
+
+
+def test_face_tracks():
+    import numpy as np
+    from scannertools.face_embedding import group_tracks, track_representatives
+    from scannertools.prelude import BBOX_CODEC
+
+    def bboxes(*boxes):
+        b = np.array(boxes, dtype=np.float64).reshape((-1, 5))
+        return BBOX_CODEC.decode(
+            BBOX_CODEC.encode_columns(
+                x1=b[:, 0], y1=b[:, 1], x2=b[:, 2], y2=b[:, 3], score=b[:, 4], label=[0] * len(b)))
+
+    anchor = lambda t, score=0.9: (0.1 + 0.01 * t, 0.1, 0.3 + 0.01 * t, 0.4, score)
+    guest = (0.6, 0.5, 0.7, 0.7, 0.8)
+    rows = [bboxes(anchor(0)), bboxes(anchor(1), guest), None, bboxes(guest, anchor(3, 0.99))]
+    track_ids, num_tracks = group_tracks(rows)
+    assert [list(ids) for ids in track_ids] == [[0], [0, 1], [], [1, 0]] and num_tracks == 2
+
+    rows, idxs, tracks = track_representatives(rows, track_ids, num_tracks, 1)
+    assert list(rows) == [1, 3] and list(idxs) == [1, 1] and list(tracks) == [1, 0]
+
+
+def test_shared_tf_kernel():
+    import tensorflow as tf
+    from types import SimpleNamespace
+    from scannertools.tf_kernel import SharedTensorFlowKernel
+
+    loads = []
+
+    class Constant(SharedTensorFlowKernel):
+        def build_graph(self):
+            graph = tf.Graph()
+            with graph.as_default():
+                tf.constant(1.0, name='one')
+            return graph
+
+        def load_model(self):
+            loads.append(self.config.args['model_dir'])
+            return self.graph.get_tensor_by_name('one:0')
+
+        def warm_up(self):
+            assert self.sess.run(self.model) == 1.0
+
+    config = lambda model_dir: SimpleNamespace(
+        args={'model_dir': model_dir}, devices=[], protobufs=None)
+    kernels = [Constant(config('a')), Constant(config('a')), Constant(config('b'))]
+    assert loads == ['a', 'b']
+    assert kernels[0].sess is kernels[1].sess and kernels[0].sess is not kernels[2].sess
+
+    # Instances created concurrently still load the model once
+    threads = [threading.Thread(target=Constant, args=(config('c'), )) for _ in range(4)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    assert loads == ['a', 'b', 'c']
+
+
+def test_face_index(tmpdir):
+    import numpy as np
+    from scannertools.face_index import FaceIndex, build_index
+    from scannertools.prelude import DataSource
+
+    class Rows(DataSource):
+        def __init__(self, rows):
+            self._rows = rows
+
+        def load(self):
+            return iter(self._rows)
+
+    rng = np.random.RandomState(0)
+    vectors = rng.randn(2000, 16).astype(np.float32)
+    rows = [vectors[i:i + 2] for i in range(0, 1000, 2)] + [None]
+    for storage in ['float16', 'pq']:
+        path = str(tmpdir.join(storage))
+        build_index(
+            path, ['a', 'b'], [Rows(rows), Rows([vectors[1000:]])],
+            nlist=8,
+            storage=storage,
+            pq_m=4)
+        index = FaceIndex(path)
+        assert len(index) == 2000
+        [matches] = index.search(vectors[[3]], k=5, nprobe=8)
+        assert (matches[0].video, matches[0].frame, matches[0].bbox) == ('a', 1, 1)
+
+        index.add(vectors[[3]] + 0.01, 'c', [7], [0])
+        [matches] = FaceIndex(path).search(vectors[[3]], k=2, nprobe=8)
+        assert set(m.video for m in matches) == {'a', 'c'}
+
+
+def test_face_clustering():
+    import numpy as np
+    from scannertools.face_clustering import minibatch_kmeans, assign_clusters, _stream_batches
+    from scannertools.prelude import DataSource
+    from types import SimpleNamespace
+
+    class Rows(DataSource):
+        def __init__(self, rows):
+            self._rows = rows
+
+        def load(self):
+            return iter(self._rows)
+
+    rng = np.random.RandomState(0)
+    centers = np.eye(8, dtype=np.float32) * 10
+    labels = rng.randint(0, 8, 3000)
+    vectors = centers[labels] + rng.randn(3000, 8).astype(np.float32)
+    columns = [Rows([vectors[i:i + 3] for i in range(j, j + 1500, 3)] + [None])
+               for j in [0, 1500]]
+    assert [len(b) for b in _stream_batches(columns, 1000)] == [1000, 1000, 1000]
+
+    centroids = minibatch_kmeans(columns, 8, batch_size=1000, epochs=2)
+    assert np.allclose(np.sort(np.abs(centroids).max(axis=1)), 10, atol=0.5)
+
+    class Column:
+        def __init__(self, rows):
+            self._rows = rows
+
+        def load(self, parser):
+            return (parser(row) for [row] in self._rows)
+
+    class Database:
+        tables = {}
+
+        def new_table(self, name, columns, rows, force=False):
+            self.tables[name] = rows
+            return SimpleNamespace(column=lambda _: Column(rows))
+
+    rows = [vectors[:2], np.zeros((0, 8)), None, vectors[2:3]]
+    db = Database()
+    [clusters] = assign_clusters(db, [Rows(rows)], centroids, suffix='test_clusters')
+    assert list(db.tables.keys()) == ['0_test_clusters']
+    loaded = list(clusters.load())
+    assert [len(c) for c in loaded] == [2, 0, 0, 1]
+    nearest = lambda v: np.argmin(((centroids - v)**2).sum(axis=1))
+    assert list(loaded[0]) == [nearest(v) for v in vectors[:2]]
+    assert list(loaded[3]) == [nearest(vectors[2])]
+
+
+def test_gate():
+    from scannertools.prelude import Pipeline, DataSource, BBOX_CODEC
+    from scannertools.shot_detection import ShotDetectionPipeline
+
+    class Rows(DataSource):
+        def __init__(self, rows):
+            self._rows = rows
+
+        def load(self):
+            return iter(self._rows)
+
+    def bboxes(*scores):
+        n = len(scores)
+        return BBOX_CODEC.decode(
+            BBOX_CODEC.encode_columns(
+                x1=[0] * n, y1=[0] * n, x2=[1] * n, y2=[1] * n, score=scores, label=[1] * n))
+
+    gate = [
+        Rows([bboxes(0.9), bboxes(), bboxes(0.2), bboxes(0.2, 0.8)]),
+        Rows([bboxes(0.1), bboxes()])
+    ]
+    pipeline = Pipeline(None)
+    videos, frames, sources = pipeline._apply_gate(['a', 'b'], [[0, 10, 20, 30], [0, 10]],
+                                                   {'bboxes': gate}, True, 0.5, None)
+    assert videos == ['a'] and frames == [[0, 30]] and sources['bboxes'] == gate[:1]
+
+    [a, b] = pipeline._scatter_gated([Rows(['x', 'y'])])
+    assert list(a.load()) == ['x', None, None, 'y'] and list(b.load()) == [None, None]
+
+    shots = ShotDetectionPipeline(None)
+    shots._gate = pipeline._gate
+    assert shots._scatter_gated([[1]]) == [[3], []]
+
+    # If no frame passes the gate, nothing is run and every row loads as None
+    from types import SimpleNamespace
+
+    class Embed(Pipeline):
+        job_suffix = 'embed'
+        additional_sources = ['bboxes']
+
+        def build_pipeline(self):
+            raise Exception('Nothing should be run')
+
+    db = SimpleNamespace(
+        has_gpu=lambda: False,
+        sources=SimpleNamespace(FrameColumn=lambda: None),
+        streams=SimpleNamespace(Gather=lambda op: op))
+    [empty] = Embed.make_runner()(db, videos=['a'], bboxes=[Rows([bboxes(), bboxes()])], gate=True)
+    assert list(empty.load()) == [None, None]
+
+    # Gate arguments reach the base build_sources even if an override doesn't list them
+    class Sources(Pipeline):
+        def build_sources(self, videos=None, stride=1, **kwargs):
+            pass
+
+        def execute(self, source_args={}, **kwargs):
+            return source_args
+
+    assert Sources.make_runner()(None, videos=[], gate=True, gate_min_score=0.5) == {
+        'videos': [],
+        'gate': True,
+        'gate_min_score': 0.5
+    }
+
 
 def test_montage(video):
     video.montage([0, 1], cols=2)
@@ -109,10 +713,52 @@ def test_montage(video):
 
 def test_optical_flow(db, video):
     flows = optical_flow.compute_flow(db, videos=[video], frames=[[1]])
+    [(flow, summary)] = optical_flow.compute_flow(
+        db, videos=[video], frames=[[1]], precision='int8', downsample=4, summary=True)
+    assert next(flow.load()).shape == (video.height() // 4, video.width() // 4, 2)
+    assert len(next(summary.load())) == 1
+    [flow] = optical_flow.compute_flow(
+        db, videos=[video], algorithm='dis', preset='ultrafast', pair_stride=10, precision='int8')
+    assert next(flow.load()).shape == (video.height(), video.width(), 2)
+
+
+def test_dis_flow():
+    import numpy as np
+    import cv2
+    from scannertools.optical_flow import DISOpticalFlow
+    from types import SimpleNamespace
+
+    rng = np.random.RandomState(0)
+    img = cv2.GaussianBlur((rng.rand(200, 340, 3) * 255).astype(np.uint8), (9, 9), 3)
+    prev, cur = img[20:180, 20:320].copy(), img[20:180, 12:312].copy()
+    for upsample in [True, False]:
+        kernel = DISOpticalFlow(
+            SimpleNamespace(args={'preset': 'fast', 'scale': None, 'upsample': upsample}))
+        flow = kernel.execute([prev, cur])
+        assert flow.shape == ((160, 300, 2) if upsample else (80, 150, 2))
+        assert abs(np.median(flow[..., 0]) - 8) < 1
+
+
+def test_flow_encoding():
+    import numpy as np
+    from scannertools.optical_flow import encode_flow, decode_flow, downsample_flow
+
+    flow = np.random.RandomState(0).randn(64, 96, 2).astype(np.float32) * 5
+    for precision, tolerance in [('float32', 0), ('float16', 0.01), ('int8', 0.2)]:
+        decoded = decode_flow(encode_flow(flow, precision=precision, downsample=4))
+        assert decoded.shape == (16, 24, 2)
+        assert np.abs(decoded - downsample_flow(flow, 4)).max() <= tolerance
 
 
 def test_shot_detection(db, video):
-    shot_detection.detect_shots(db, videos=[video], run_opts={'work_packet_size': 10})
+    [boundaries] = shot_detection.detect_shots(
+        db, videos=[video], run_opts={'work_packet_size': 10})
+    [streamed] = shot_detection.detect_shots(
+        db, videos=[video], streaming=True, run_opts={'work_packet_size': 10})
+    assert streamed == boundaries
+    [strided] = shot_detection.detect_shots(
+        db, videos=[video], stride=8, run_opts={'work_packet_size': 10})
+    assert strided == boundaries
 
 
 @needs_gpu